@@ -0,0 +1,266 @@
+"""
+Benchmark suite for the Round 1A outline extractor.
+
+Generates synthetic PDFs with PyMuPDF (controllable page count, lines per page,
+font size distribution and heading density), times extract_outline on each of
+them and process_pdfs_in_directory over the whole set, and reports throughput
+(pages/s, lines/s) and peak RSS. Every case is measured in a fresh process so
+peak RSS belongs to that case alone.
+
+Usage:
+    python benchmark.py                    # run and print the report
+    python benchmark.py --quick            # smaller cases, for a fast sanity check
+    python benchmark.py --update-baseline  # store the results as the new baseline
+    python benchmark.py --check            # exit 1 if any case regressed past the baseline
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+import fitz # PyMuPDF
+
+import main
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Font size distributions: body text size plus H1/H2/H3 sizes
+FONT_PROFILES = {
+    "wide": {"body": 10, "headings": [28, 20, 16]},
+    "narrow": {"body": 11, "headings": [20, 16, 13]},
+    "flat": {"body": 12, "headings": [12, 12, 12]} # Headings only distinguishable by bold/numbering
+}
+
+# One axis is varied at a time from the base case
+BASE_CASE = {"pages": 50, "lines_per_page": 40, "font_profile": "wide", "heading_density": 0.1}
+AXES = {
+    "pages": [10, 50, 200],
+    "lines_per_page": [10, 40, 80],
+    "font_profile": ["wide", "narrow", "flat"],
+    "heading_density": [0.02, 0.1, 0.4]
+}
+QUICK_AXES = {
+    "pages": [5, 20],
+    "lines_per_page": [10, 40],
+    "font_profile": ["wide", "flat"],
+    "heading_density": [0.02, 0.4]
+}
+
+WORDS = ("document section analysis outline heading structure report summary data "
+         "results method overview table figure appendix review scope budget plan").split()
+
+def build_cases(axes, base_pages=None):
+    """
+    Expands the axes into a de-duplicated list of named cases.
+    """
+    base = dict(BASE_CASE)
+    if base_pages:
+        base["pages"] = base_pages
+    cases = {}
+    for axis, values in axes.items():
+        for value in values:
+            case = dict(base, **{axis: value})
+            name = "p{pages}-l{lines_per_page}-{font_profile}-h{heading_density}".format(**case)
+            cases[name] = dict(case, name=name)
+    return list(cases.values())
+
+def generate_pdf(path, pages, lines_per_page, font_profile, heading_density, seed=0):
+    """
+    Writes a synthetic PDF. Headings are bold, numbered ("2.1 ...") and use the
+    profile's heading sizes; everything else is body text. Page height grows
+    with lines_per_page so lines never overlap.
+    """
+    rng = random.Random(seed)
+    profile = FONT_PROFILES[font_profile]
+    line_gap = max(profile["headings"]) * 1.3
+    page_height = 80 + lines_per_page * line_gap
+    numbering = [0, 0, 0]
+
+    document = fitz.open()
+    for _ in range(pages):
+        page = document.new_page(width=595, height=page_height)
+        y = 40 + line_gap
+        for _ in range(lines_per_page):
+            if rng.random() < heading_density:
+                level = rng.randrange(3)
+                numbering[level] += 1
+                for deeper in range(level + 1, 3):
+                    numbering[deeper] = 0
+                number = ".".join(str(max(n, 1)) for n in numbering[:level + 1])
+                text = f"{number} {' '.join(rng.sample(WORDS, 3)).title()}"
+                page.insert_text((40, y), text, fontsize=profile["headings"][level], fontname="hebo")
+            else:
+                text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12))).capitalize() + "."
+                page.insert_text((40, y), text, fontsize=profile["body"], fontname="helv")
+            y += line_gap
+    document.save(path)
+    document.close()
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _measure_extract(pdf_path, repeats):
+    """
+    Child-process task: best-of-N timing of extract_outline plus the process's peak RSS.
+    """
+    best = None
+    for _ in range(repeats):
+        metrics = main.DocumentMetrics(os.path.basename(pdf_path))
+        start = time.perf_counter()
+        main.extract_outline(pdf_path, metrics)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, metrics)
+    elapsed, metrics = best
+    return {"seconds": elapsed, "counters": metrics.counters, "stages": metrics.stages, "peak_rss_mb": _peak_rss_mb()}
+
+def _measure_directory(input_dir, output_dir, workers):
+    """
+    Child-process task: one timed process_pdfs_in_directory run plus peak RSS.
+    """
+    metrics = main.RunMetrics()
+    start = time.perf_counter()
+    main.process_pdfs_in_directory(input_dir, output_dir, workers=workers, metrics=metrics)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "counters": metrics.report()["counter_totals"], "peak_rss_mb": _peak_rss_mb()}
+
+def _run_and_report(results, func, args):
+    try:
+        results.put(("ok", func(*args)))
+    except BaseException:
+        results.put(("error", traceback.format_exc()))
+
+def _in_fresh_process(func, *args):
+    # "spawn" so each measurement starts from a clean interpreter and its own peak RSS.
+    # A plain Process rather than a Pool worker: pool workers are daemonic and
+    # could not start the directory run's own process pool.
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run_and_report, args=(results, func, args))
+    process.start()
+    try:
+        while True:
+            try:
+                status, result = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"benchmark process exited with code {process.exitcode}")
+    finally:
+        process.join()
+    if status != "ok":
+        raise RuntimeError(f"benchmark process failed:\n{result}")
+    return result
+
+def _throughput(result):
+    seconds = result["seconds"] or 1e-9
+    return {
+        "seconds": round(result["seconds"], 4),
+        "pages_per_second": round(result["counters"]["pages"] / seconds, 1),
+        "lines_per_second": round(result["counters"]["lines"] / seconds, 1),
+        "peak_rss_mb": round(result["peak_rss_mb"], 1)
+    }
+
+def run_benchmarks(cases, repeats, workers):
+    """
+    Generates every case into a temporary directory and measures it.
+    Returns {case_name: metrics} including a "directory" entry per worker count.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_dir = os.path.join(work_dir, "input")
+        output_dir = os.path.join(work_dir, "output")
+        os.makedirs(input_dir)
+        os.makedirs(output_dir)
+
+        for case in cases:
+            pdf_path = os.path.join(input_dir, case["name"] + ".pdf")
+            generate_pdf(pdf_path, case["pages"], case["lines_per_page"], case["font_profile"], case["heading_density"])
+            result = _in_fresh_process(_measure_extract, pdf_path, repeats)
+            results[case["name"]] = dict(_throughput(result), headings=result["counters"]["headings"])
+            print(f"{case['name']:<32} {results[case['name']]['pages_per_second']:>9.1f} pages/s "
+                  f"{results[case['name']]['lines_per_second']:>11.1f} lines/s "
+                  f"{results[case['name']]['peak_rss_mb']:>7.1f} MB")
+
+        for worker_count in sorted({1, workers}):
+            result = _in_fresh_process(_measure_directory, input_dir, output_dir, worker_count)
+            name = f"directory-w{worker_count}"
+            results[name] = _throughput(result)
+            print(f"{name:<32} {results[name]['pages_per_second']:>9.1f} pages/s "
+                  f"{results[name]['lines_per_second']:>11.1f} lines/s "
+                  f"{results[name]['peak_rss_mb']:>7.1f} MB")
+    return results
+
+def check_against_baseline(results, baseline, tolerance):
+    """
+    Returns a list of regression messages: throughput below, or peak RSS above,
+    the baseline by more than tolerance (a fraction). Cases missing from the
+    baseline are ignored.
+    """
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        if current["pages_per_second"] < reference["pages_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['pages_per_second']} pages/s vs baseline {reference['pages_per_second']}")
+        if current["peak_rss_mb"] > reference["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: {current['peak_rss_mb']} MB peak RSS vs baseline {reference['peak_rss_mb']}")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark extract_outline on synthetic PDFs.")
+    parser.add_argument("--quick", action="store_true", help="smaller cases for a fast sanity check")
+    parser.add_argument("--pages", type=int, help="override the base case page count")
+    parser.add_argument("--repeats", type=int, default=3, help="best-of-N repeats per case (default 3)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker count for the parallel directory run")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file (default benchmark_baseline.json)")
+    parser.add_argument("--check", action="store_true", help="fail if results regress past the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression as a fraction (default 0.25)")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the baseline")
+    args = parser.parse_args()
+
+    cases = build_cases(QUICK_AXES if args.quick else AXES, args.pages)
+    results = run_benchmarks(cases, args.repeats, args.workers)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"Baseline updated: {args.baseline}")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --update-baseline first.")
+            return 1
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = check_against_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Performance regressions:")
+            for message in regressions:
+                print(f"  {message}")
+            return 1
+        print("No regressions against baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
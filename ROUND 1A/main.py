@@ -1,267 +1,952 @@
 import fitz # PyMuPDF library, often imported as 'fitz'
 import json
 import os
+import sys
+import shutil
 import traceback
 import logging # Import the logging module
 import re # Import re once at the top
+import signal
+import cProfile
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+
+# The layout pass and heading rules are shared with Round 1B: pdf_layout.py sits
+# next to this file in the image, and in ../common in a source checkout.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from pdf_layout import (
+    HEURISTICS_VERSION, LEVEL_NAMES, MemoryMonitor, classify_records, compute_font_thresholds,
+    extract_line_records, extract_title, hash_file, load_layout, open_document, thresholds_from_histogram
+)
+
+# --- Instrumentation: stage timers and counters for the metrics report ---
+class DocumentMetrics:
+    """
+    Stage timings (seconds) and counters for one document. Stages used by the
+    extractor: open, toc, layout, title, histogram, classify, write, cache, and
+    scan/stream in streaming mode. peak_rss_mb is the highest resident memory
+    of the process that read the pages, sampled after every page.
+    """
+    __slots__ = ("file", "stages", "counters", "peak_rss_mb")
+
+    def __init__(self, file):
+        self.file = file
+        self.stages = {}
+        self.counters = {"pages": 0, "lines": 0, "headings": 0}
+        self.peak_rss_mb = 0.0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other):
+        """
+        Folds in timings and counters recorded elsewhere (e.g. by a pool worker).
+        """
+        for name, seconds in other.stages.items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        self.counters.update(other.counters)
+        self.peak_rss_mb = max(self.peak_rss_mb, other.peak_rss_mb)
+
+    def record_peak(self, monitor):
+        self.peak_rss_mb = max(self.peak_rss_mb, monitor.peak_mb)
+
+    def as_dict(self):
+        return {"file": self.file, "stages": self.stages, "counters": self.counters, "peak_rss_mb": self.peak_rss_mb}
+
+class RunMetrics:
+    """
+    Collects DocumentMetrics for a whole run and renders the JSON metrics report.
+    """
 
-# Configure logging at the beginning of your script
-logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(message)s')
-
-def extract_outline(pdf_path):
+    def __init__(self):
+        self.documents = []
+        self.started = time.perf_counter()
+
+    def new_document(self, file):
+        metrics = DocumentMetrics(file)
+        self.documents.append(metrics)
+        return metrics
+
+    def report(self):
+        stage_totals = {}
+        counter_totals = {}
+        for metrics in self.documents:
+            for name, seconds in metrics.stages.items():
+                stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+            for name, count in metrics.counters.items():
+                counter_totals[name] = counter_totals.get(name, 0) + count
+        return {
+            "elapsed_seconds": time.perf_counter() - self.started,
+            "stage_totals": stage_totals,
+            "counter_totals": counter_totals,
+            "max_peak_rss_mb": max((metrics.peak_rss_mb for metrics in self.documents), default=0.0),
+            "documents": [metrics.as_dict() for metrics in self.documents]
+        }
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=4)
+
+def _stage(metrics, name):
     """
-    Extracts title and hierarchical headings (H1, H2, H3) from a PDF.
+    Times a stage on metrics, or does nothing when metrics are off.
     """
-    logging.debug(f"Entering extract_outline for: {pdf_path}")
-    document = fitz.open(pdf_path)
+    return metrics.stage(name) if metrics else nullcontext()
 
+def build_outline(records, metrics=None):
+    """
+    Builds the {"title", "outline"} result from a document's line records.
+    Records must cover the whole document in page order.
+    """
     # --- 1. Extract Title ---
-    title = ""
-    if document.page_count > 0:
-        first_page = document[0]
-        max_title_font_size = 0
-        potential_title_lines = []
-
-        # Get all text blocks and lines from the first page
-        blocks = first_page.get_text("dict")["blocks"]
-
-        # Iterate through blocks and lines to find the largest/boldest text on the first page
-        for block in blocks:
-            if block["type"] == 0: # text block
-                for line in block["lines"]:
-                    # Join spans to reassemble potentially fragmented text, and strip
-                    line_text = "".join([span["text"] for span in line["spans"]]).strip()
-                    if not line_text:
-                        continue
-
-                    # Get properties of the first span as representative for the line
-                    if not line["spans"]: # Skip if no spans (empty line)
-                        continue
-                    first_span = line["spans"][0]
-                    line_font_size = first_span["size"]
-                    line_font_name = first_span["font"]
-                    line_is_bold = "Bold" in line_font_name or (first_span["flags"] & 16)
-
-                    # Accumulate potential title lines, looking for the most prominent one
-                    # Only consider if bold or very large, and not a short, number-like string
-                    if (line_is_bold or line_font_size >= 28) and \
-                       len(line_text) > 5 and \
-                       not line_text.isdigit() and \
-                       not re.match(r'^\d+(\.\d+){0,2}\s*$', line_text): # Exclude just numbers/patterns like "1."
-
-                        if line_font_size > max_title_font_size:
-                            max_title_font_size = line_font_size
-                            potential_title_lines = [line_text] # Start new potential title if larger font found
-                        elif line_font_size == max_title_font_size:
-                            potential_title_lines.append(line_text) # If same largest font size, append for multi-line titles
-
-        # Join the collected lines to form the title
-        if potential_title_lines:
-            title = " ".join(potential_title_lines)
-            # A final check to ensure it's not a short or trivial title that might have slipped through
-            if len(title) < 10 or re.match(r'^(RFP:\s*(Request)?\s*for\s*Proposal|March\s*\d{1,2},\s*\d{4})$', title, re.IGNORECASE):
-                title = "" # Reset if too short or a known header/footer pattern
+    with _stage(metrics, "title"):
+        title = extract_title(records)
 
     # --- 2. Extract Headings (H1, H2, H3) ---
-    outline = []
-    
-    # Store font sizes encountered to help normalize/compare
+    with _stage(metrics, "histogram"):
+        thresholds = compute_font_thresholds(records)
+    with _stage(metrics, "classify"):
+        outline = classify_records(records, thresholds)
+    return {
+        "title": title,
+        "outline": outline
+    }
+
+def source_name(source):
+    """
+    Printable name for a PDF source, so log lines never dump raw bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return f"<{len(source)} bytes>"
+    return source
+
+# --- Embedded outline (bookmarks) fast path ---
+# A single bookmark is more often a stray link than a real table of contents
+MIN_TOC_ENTRIES = 2
+# Share of bookmarks that must point at a real page, and of consecutive pairs that must not go backwards
+MIN_TOC_VALID_PAGES = 0.9
+MIN_TOC_ORDERED_PAIRS = 0.8
+# Metadata titles that are authoring-tool leftovers rather than real titles
+JUNK_METADATA_TITLE_PATTERN = re.compile(r'^(Microsoft Word - |Slide \d+$|Untitled)|\.(docx?|pptx?|xlsx?|pub|cdr|indd|pdf)$', re.IGNORECASE)
+
+def is_plausible_toc(toc, page_count):
+    """
+    Sanity checks for document.get_toc() output: enough entries, starts at level 1,
+    never skips a level going deeper, non-empty titles, pages that exist and
+    mostly run forwards.
+    """
+    if len(toc) < MIN_TOC_ENTRIES or toc[0][0] != 1:
+        return False
+    valid_pages = 0
+    ordered_pairs = 0
+    previous_level, previous_page = 0, 0
+    for level, text, page in toc:
+        if not text.strip() or level > previous_level + 1:
+            return False
+        if 1 <= page <= page_count:
+            valid_pages += 1
+        if page >= previous_page:
+            ordered_pairs += 1
+        previous_level, previous_page = level, page
+    return valid_pages >= MIN_TOC_VALID_PAGES * len(toc) and ordered_pairs >= MIN_TOC_ORDERED_PAIRS * len(toc)
+
+def metadata_title(document):
+    """
+    Returns the metadata title, or "" if it is missing or looks like a file name.
+    """
+    title = ((document.metadata or {}).get("title") or "").strip()
+    if len(title) < 3 or JUNK_METADATA_TITLE_PATTERN.search(title):
+        return ""
+    return title
+
+def read_embedded_outline(document, metrics=None):
+    """
+    Builds the {"title", "outline"} result from the document's bookmarks, mapping
+    bookmark levels 1-3 to H1-H3 (deeper levels are dropped). The title comes from
+    the metadata, or from the first page's heuristics if the metadata title is junk.
+    Returns None when the TOC is missing or fails is_plausible_toc.
+    """
+    toc = document.get_toc()
+    if not is_plausible_toc(toc, document.page_count):
+        return None
+
+    title = metadata_title(document)
+    if not title and document.page_count > 0:
+        with _stage(metrics, "title"):
+            title = extract_title(extract_line_records(document, 0, 1))
+
+    outline = [
+        {"level": LEVEL_NAMES[level], "text": text.strip(), "page": page}
+        for level, text, page in toc
+        if level <= 3 and 1 <= page <= document.page_count
+    ]
+    if metrics:
+        metrics.counters["pages"] = document.page_count
+        metrics.counters["headings"] = len(outline)
+        metrics.counters["toc_hits"] = 1
+    return {
+        "title": title,
+        "outline": outline
+    }
+
+def extract_toc_outline(pdf_path, metrics=None):
+    """
+    Opens a PDF and returns its bookmark-based outline, or None (see read_embedded_outline).
+    """
+    with _stage(metrics, "open"):
+        document = open_document(pdf_path)
+    try:
+        with _stage(metrics, "toc"):
+            return read_embedded_outline(document, metrics)
+    finally:
+        document.close()
+
+def extract_page_records(pdf_path, start_page=0, end_page=None):
+    """
+    Opens a PDF and returns (line records for the given page range, peak RSS
+    in MB while reading them).
+    """
+    monitor = MemoryMonitor()
+    document = open_document(pdf_path)
+    try:
+        return extract_line_records(document, start_page, end_page, monitor), monitor.peak_mb
+    finally:
+        document.close()
+
+def extract_outline(pdf_path, metrics=None, use_toc=False):
+    """
+    Extracts title and hierarchical headings (H1, H2, H3) from a PDF, given
+    as a file path or as the file's bytes. Pass a DocumentMetrics to record stage timings and counters.
+    With use_toc, a plausible embedded table of contents is returned as is and
+    the layout heuristics only run for documents without one.
+    """
+    logging.debug("Entering extract_outline for: %s", source_name(pdf_path))
+    with _stage(metrics, "open"):
+        document = open_document(pdf_path)
+    try:
+        if use_toc:
+            with _stage(metrics, "toc"):
+                outline_data = read_embedded_outline(document, metrics)
+            if outline_data:
+                logging.debug("Using %d embedded bookmarks for %s", len(outline_data["outline"]), source_name(pdf_path))
+                return outline_data
+        # A single layout pass (or the cached layout model) feeds the title, histogram and heading stages
+        monitor = MemoryMonitor()
+        with _stage(metrics, "layout"):
+            model = load_layout(pdf_path, document, monitor=monitor)
+        records = model.records
+        page_count = model.page_count
+    finally:
+        document.close()
+    outline_data = build_outline(records, metrics)
+    if metrics:
+        metrics.record_peak(monitor)
+        metrics.counters["pages"] = page_count
+        metrics.counters["lines"] = len(records)
+        metrics.counters["headings"] = len(outline_data["outline"])
+    logging.debug("Extracted %d outline entries for %s", len(outline_data["outline"]), source_name(pdf_path))
+    return outline_data
+
+def _run_with_metrics(func, pdf_path, *args):
+    """
+    Pool task: runs func(pdf_path, *args, metrics=...) and returns (result, metrics).
+    DocumentMetrics pickles back to the parent along with the result.
+    """
+    metrics = DocumentMetrics(os.path.basename(pdf_path))
+    return func(pdf_path, *args, metrics=metrics), metrics
+
+def scan_document(document, metrics=None, monitor=None):
+    """
+    Lightweight pre-pass for streaming: reads every page once but keeps only the
+    font size histogram and the first page's lines (for the title), so memory
+    stays bounded by a single page. Returns (title, thresholds).
+    """
     font_sizes = {}
+    title = ""
     for page_num in range(document.page_count):
-        page = document[page_num]
-        blocks = page.get_text("dict")["blocks"]
-        for b in blocks:
-            if b["type"] == 0: # Only process text blocks
-                for line in b["lines"]:
-                    if not line["spans"]:
-                        continue
-                    first_span = line["spans"][0]
-                    size = first_span["size"]
-                    if size not in font_sizes:
-                        font_sizes[size] = 0
-                    font_sizes[size] += 1
-    
-    # Sort font sizes to determine relative importance (largest usually H1)
-    sorted_font_sizes = sorted(font_sizes.keys(), reverse=True)
-    
-    # Define thresholds dynamically or based on common PDF patterns
-    # These are illustrative and might need fine-tuning for diverse PDFs
-    h1_threshold = sorted_font_sizes[0] if sorted_font_sizes else 0
-    h2_threshold = sorted_font_sizes[1] if len(sorted_font_sizes) > 1 else h1_threshold * 0.8
-    h3_threshold = sorted_font_sizes[2] if len(sorted_font_sizes) > 2 else h2_threshold * 0.8
-
-    # Apply some minimums to avoid picking up body text as headings if dynamic thresholds are too low
-    h1_min = 20 # Absolute minimum for H1
-    h2_min = 16 # Absolute minimum for H2
-    h3_min = 12 # Absolute minimum for H3
-    
-    h1_threshold = max(h1_threshold, h1_min)
-    h2_threshold = max(h2_threshold, h2_min)
-    h3_threshold = max(h3_threshold, h3_min)
-
-    # Adjust H2 and H3 relative to H1 if they are too close
-    if h2_threshold >= h1_threshold:
-        h2_threshold = h1_threshold * 0.85
-    if h3_threshold >= h2_threshold:
-        h3_threshold = h2_threshold * 0.85
-
-    logging.debug(f"Dynamic Font Size Thresholds: H1={h1_threshold:.2f}, H2={h2_threshold:.2f}, H3={h3_threshold:.2f}")
+        page_records = extract_line_records(document, page_num, page_num + 1, monitor)
+        if page_num == 0:
+            title = extract_title(page_records)
+        for record in page_records:
+            font_sizes[record.size] = font_sizes.get(record.size, 0) + 1
+    if metrics:
+        metrics.counters["pages"] = document.page_count
+        metrics.counters["lines"] = sum(font_sizes.values())
+    return title, thresholds_from_histogram(font_sizes)
+
+# Sampled thresholds for streaming: how far (relative) either half of the page
+# sample may move a threshold before the sample is deemed unstable
+SAMPLE_STABILITY_TOLERANCE = 0.05
+
+def sample_page_numbers(page_count, sample_pages):
+    """
+    Stratified page sample: the document is cut into sample_pages equal strata
+    and the middle page of each is taken. The first page is always included,
+    since it holds the title and usually the largest fonts.
+    """
+    if page_count <= sample_pages:
+        return list(range(page_count))
+    return sorted({0} | {(2 * stratum + 1) * page_count // (2 * sample_pages) for stratum in range(sample_pages)})
 
+def thresholds_agree(estimate, reference, tolerance=SAMPLE_STABILITY_TOLERANCE):
+    return all(abs(value - target) <= tolerance * target for value, target in zip(estimate, reference))
 
+def sample_document(document, sample_pages, metrics=None, monitor=None):
+    """
+    Sampled pre-pass for streaming: reads only a stratified sample of pages
+    (see sample_page_numbers) and estimates the thresholds from their font
+    size histogram. The sample is split into two interleaved halves (both
+    with the first page); if either half's thresholds are more than
+    SAMPLE_STABILITY_TOLERANCE away from the whole sample's, the distribution
+    is unstable and None is returned, so the caller builds the full histogram
+    instead. Returns (title, thresholds) otherwise.
+    """
+    page_numbers = sample_page_numbers(document.page_count, sample_pages)
+    font_sizes = {}
+    halves = ({}, {})
+    title = ""
+    for position, page_num in enumerate(page_numbers):
+        page_records = extract_line_records(document, page_num, page_num + 1, monitor)
+        if page_num == 0:
+            title = extract_title(page_records)
+        histograms = (font_sizes,) + (halves if page_num == 0 else (halves[position % 2],))
+        for record in page_records:
+            for histogram in histograms:
+                histogram[record.size] = histogram.get(record.size, 0) + 1
+    if metrics:
+        metrics.counters["sampled_pages"] = len(page_numbers)
+
+    thresholds = thresholds_from_histogram(font_sizes)
+    if len(page_numbers) < document.page_count and not all(
+            thresholds_agree(thresholds_from_histogram(half), thresholds) for half in halves):
+        return None
+    return title, thresholds
+
+def diff_outlines(sampled, exact):
+    """
+    Counts how a sampled outline differs from the exact one: headings it
+    misses, extra headings it has, and headings found by both at another level.
+    """
+    sampled_lines = Counter((entry["page"], entry["text"]) for entry in sampled)
+    exact_lines = Counter((entry["page"], entry["text"]) for entry in exact)
+    same_level = Counter((entry["page"], entry["text"], entry["level"]) for entry in sampled) & \
+                 Counter((entry["page"], entry["text"], entry["level"]) for entry in exact)
+    return {
+        "headings_missing": sum((exact_lines - sampled_lines).values()),
+        "headings_extra": sum((sampled_lines - exact_lines).values()),
+        "level_changes": sum((sampled_lines & exact_lines).values()) - sum(same_level.values())
+    }
+
+def check_sampled_thresholds(document, thresholds, font_sizes, entries=None, metrics=None, monitor=None):
+    """
+    After a sampled streaming pass, compares the estimated thresholds with the
+    exact ones from the full histogram gathered during that pass. Matching
+    thresholds mean the outline is exactly the unsampled one. Otherwise,
+    given the streamed entries, the document is classified again with the
+    exact thresholds and the differences are counted on metrics.
+    Returns (exact thresholds, diff_outlines result or None if not computed).
+    """
+    exact_thresholds = thresholds_from_histogram(font_sizes)
+    if exact_thresholds == thresholds:
+        return exact_thresholds, diff_outlines([], [])
+    if metrics:
+        metrics.counters["threshold_mismatches"] = 1
+    if entries is None:
+        return exact_thresholds, None
+    with _stage(metrics, "verify"):
+        differences = diff_outlines(entries, list(iter_outline_entries(document, exact_thresholds, monitor)))
+    if metrics:
+        metrics.counters.update(differences)
+    return exact_thresholds, differences
+
+def iter_outline_entries(document, thresholds, monitor=None, font_sizes=None):
+    """
+    Yields outline entries page by page, classifying each page as soon as it
+    has been read. Only one page of line records is alive at a time. Pass a
+    dict as font_sizes to collect the document's font size histogram on the way.
+    """
     for page_num in range(document.page_count):
-        page = document[page_num]
-        blocks = page.get_text("dict")["blocks"]
-
-        for b in blocks:
-            if b["type"] == 0: # Only process text blocks
-                for line in b["lines"]:
-                    # Reassemble line text from spans, then strip whitespace
-                    line_text = "".join([span["text"] for span in line["spans"]]).strip()
-                    
-                    if not line_text or not line["spans"]: # Skip empty lines or lines with no spans
-                        continue
+        page_records = extract_line_records(document, page_num, page_num + 1, monitor)
+        if font_sizes is not None:
+            for record in page_records:
+                font_sizes[record.size] = font_sizes.get(record.size, 0) + 1
+        yield from classify_records(page_records, thresholds)
 
-                    # Get font properties from the first span (as representative for the line)
-                    first_span = line["spans"][0]
-                    line_font_size = first_span["size"]
-                    line_font_name = first_span["font"]
-                    line_is_bold = "Bold" in line_font_name or (first_span["flags"] & 16) # Check for "Bold" in name or the bold flag
+def stream_outline_to_file(pdf_path, output_path, stream_format="json", sample_pages=None, metrics=None):
+    """
+    Writes the outline for pdf_path incrementally, flushing after every page.
+    stream_format "json" produces the same file as write_outline, written as it
+    goes; "jsonl" writes a {"title"} line followed by one heading per line.
+    Output goes to a .part file that is renamed once the document is done, so
+    a failed run never leaves a truncated outline behind.
+    With sample_pages, the thresholds are estimated from that many sampled
+    pages (see sample_document) and every page is read only once; an unstable
+    sample falls back to the full pre-pass. With metrics, a sampled outline
+    whose thresholds turn out inexact is compared against the exact one.
+    Returns the number of headings written.
+    """
+    partial_path = output_path + ".part"
+    heading_count = 0
+    monitor = MemoryMonitor()
+    with _stage(metrics, "open"):
+        document = open_document(pdf_path)
+    try:
+        with _stage(metrics, "scan"):
+            scan = sample_document(document, sample_pages, metrics, monitor) if sample_pages else None
+            if scan is None and sample_pages:
+                logging.info("Page sample of %s is unstable; building the full font size histogram", pdf_path)
+                if metrics:
+                    metrics.counters["sample_escalations"] = 1
+            title, thresholds = scan or scan_document(document, metrics, monitor)
+        # A sampled run gathers the full histogram (and, to measure the error, the entries) while streaming
+        font_sizes = {} if scan else None
+        entries = [] if scan and metrics else None
+        with _stage(metrics, "stream"), open(partial_path, "w", encoding="utf-8") as f:
+            if stream_format == "jsonl":
+                f.write(json.dumps({"title": title}, ensure_ascii=False) + "\n")
+            else:
+                f.write('{\n    "title": ' + json.dumps(title, ensure_ascii=False) + ',\n    "outline": [')
+
+            last_page = 0
+            for entry in iter_outline_entries(document, thresholds, monitor, font_sizes):
+                if entries is not None:
+                    entries.append(entry)
+                if stream_format == "jsonl":
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                else:
+                    # Match json.dump(..., indent=4) for an entry nested two levels deep
+                    entry_json = json.dumps(entry, indent=4, ensure_ascii=False).replace("\n", "\n        ")
+                    f.write(("," if heading_count else "") + "\n        " + entry_json)
+                heading_count += 1
+                if entry["page"] != last_page:
+                    f.flush()
+                    last_page = entry["page"]
+                    logging.debug("Streamed headings up to page %d/%d of %s", last_page, document.page_count, pdf_path)
+
+            if stream_format != "jsonl":
+                f.write("\n    ]\n}" if heading_count else "]\n}")
+        if font_sizes is not None:
+            if metrics:
+                metrics.counters["pages"] = document.page_count
+                metrics.counters["lines"] = sum(font_sizes.values())
+            exact_thresholds, differences = check_sampled_thresholds(document, thresholds, font_sizes, entries, metrics, monitor)
+            if exact_thresholds != thresholds:
+                logging.warning("Sampled thresholds for %s (%s) differ from the exact ones (%s)%s", pdf_path,
+                                ", ".join(f"{value:.2f}" for value in thresholds), ", ".join(f"{value:.2f}" for value in exact_thresholds),
+                                f": {differences['headings_missing']} headings missing, {differences['headings_extra']} extra, "
+                                f"{differences['level_changes']} at another level" if differences else "")
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    finally:
+        document.close()
+    os.replace(partial_path, output_path)
+    if metrics:
+        metrics.record_peak(monitor)
+        metrics.counters["headings"] = heading_count
+    return heading_count
+
+def write_toc_outline(outline_data, output_path, stream_format=None, metrics=None):
+    """
+    Writes a bookmark-based outline in the requested output format. It is
+    already complete, so there is nothing to stream: "json" output is simply
+    write_outline's.
+    """
+    with _stage(metrics, "write"):
+        if stream_format == "jsonl":
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"title": outline_data["title"]}, ensure_ascii=False) + "\n")
+                for entry in outline_data["outline"]:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        else:
+            write_outline(outline_data, output_path)
+
+def output_filename_for(filename, stream_format=None):
+    """
+    Maps an input PDF name to its output file name.
+    """
+    return filename.replace(".pdf", ".jsonl" if stream_format == "jsonl" else ".json")
 
-                    logging.debug(f"DEBUG: Page {page_num + 1}, Font Size: {line_font_size:.2f}, Is_Bold: {line_is_bold}, Text: '{line_text}'")
+def write_outline(outline_data, output_path):
+    """
+    Writes one document's outline JSON to output_path.
+    """
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(outline_data, f, indent=4, ensure_ascii=False)
 
-                    current_level = None
+def cache_key_for(pdf_path, use_toc=False, sample_pages=None):
+    """
+    Cache key for a PDF. Bookmark mode and sampled thresholds can produce a
+    different outline for the same bytes, so they get their own keys.
+    """
+    return hash_file(pdf_path) + ("-toc" if use_toc else "") + (f"-s{sample_pages}" if sample_pages else "")
 
-                    # --- Heuristic 1: Filter out known non-headings based on content or pattern ---
-                    # Filter out very short symbols, numbers, or common footer/header text
-                    if (len(line_text) < 2 and not re.match(r'^\d+(\.\d+){0,2}\s', line_text)) or \
-                       line_text in ["•", ".", "-", "—", "_", "/", "|", ":", ""] or \
-                       re.match(r'^\s*page\s+\d+\s*$', line_text, re.IGNORECASE) or \
-                       re.match(r'^(RFP:\s*To Develop the Ontario Digital Library Business Plan|March \d{4})$', line_text): # Specific footer/header
-                        continue
-                    
-                    # Specific filter for the "100 Lombard" footer on page 2 of E0H1CM114.pdf and similar footers
-                    if "Lombard" in line_text and page_num + 1 >= 2 and line_font_size < 12:
-                        continue
-                    
-                    # Heuristic to remove page numbers in isolation or as part of a short line
-                    if (line_text.isdigit() and len(line_text) <= 3) or \
-                       (re.match(r'^\d+$', line_text.replace('.', '')) and len(line_text) <= 5):
-                        continue
+CACHE_SUBDIR = "outline_cache" # The cache only ever touches this directory inside OUTLINE_CACHE_DIR
+CACHE_VERSION_PATTERN = re.compile(r'^v[^/]+$')
 
+class OutlineCache:
+    """
+    On-disk cache of written outline JSON files, keyed by the SHA-256 of the PDF
+    bytes. Entries live in cache_dir/outline_cache, under a directory per
+    HEURISTICS_VERSION, so bumping the version invalidates everything; stale
+    version directories (and nothing else) are removed when the cache is
+    opened. Least recently used entries (by mtime) are evicted once the cache
+    grows past max_bytes.
+    """
 
-                    # --- Heuristic 2: Heading Classification based on Line Properties (Font Size & Boldness) ---
-                    # Using dynamic thresholds and prioritizing bold text
-                    if line_is_bold:
-                        if line_font_size >= h1_threshold:
-                            current_level = "H1"
-                        elif line_font_size >= h2_threshold:
-                            current_level = "H2"
-                        elif line_font_size >= h3_threshold:
-                            current_level = "H3"
-                    else: # If not bold, still consider if font size is significantly large
-                        if line_font_size >= h1_threshold * 1.1: # Even larger if not bold for H1
-                            current_level = "H1"
-                        elif line_font_size >= h2_threshold * 1.1: # Larger if not bold for H2
-                             current_level = "H2"
-                        elif line_font_size >= h3_threshold * 1.1: # Larger if not bold for H3
-                             current_level = "H3"
-                                        
-                    # --- Heuristic 3: Numbering patterns (refine current_level if applicable) ---
-                    # This should refine, not necessarily override, previous font-based classification
-                    # Stronger bias for numbered headings
-                    match = re.match(r'^((\d+)(\.\d+){0,2})\s', line_text)
-                    if match:
-                        num_part = match.group(1)
-                        dot_count = num_part.count('.')
-
-                        if dot_count == 0: # e.g., "1 Introduction"
-                            # If it's a top-level number, it's very likely H1 or H2
-                            if not current_level or current_level in ["H3"]:
-                                current_level = "H1" if line_font_size >= h2_threshold else "H2" # If font size is closer to H2, make it H2
-                            elif current_level == "H2" and line_font_size >= h1_threshold:
-                                current_level = "H1" # Promote to H1 if it's a number and H1-level font
-                        elif dot_count == 1: # e.g., "1.1 Sub-section"
-                            # If it's a second-level number, lean towards H2
-                            if not current_level or current_level in ["H1", "H3"]: # Allow H1 to be demoted if it's clearly a H2 numbered item
-                                current_level = "H2"
-                        elif dot_count == 2: # e.g., "1.1.1 Sub-sub-section"
-                            # If it's a third-level number, lean towards H3
-                            if not current_level or current_level in ["H1", "H2"]:
-                                current_level = "H3"
-                    
-                    # --- Heuristic 4: All caps check (if not already classified and reasonable length) ---
-                    if not current_level and line_text.isupper() and len(line_text) > 3 and line_font_size >= h3_min:
-                        if line_font_size >= h1_threshold * 0.9:
-                            current_level = "H1"
-                        elif line_font_size >= h2_threshold * 0.9:
-                            current_level = "H2"
-                        else:
-                            current_level = "H3"
-                    
-                    # Ensure "Summary" and "Background" are caught as H2 if they fit general size criteria and not picked up already
-                    # Even if not bold, they are often key sections.
-                    if (line_text.strip().lower() == "summary" or line_text.strip().lower() == "background") and \
-                       line_font_size >= h3_threshold and (not current_level or current_level == "H3"):
-                       current_level = "H2" # Elevate to H2 if they are "Summary" or "Background" and meet min font size
-
-                    # Only append to outline if a heading level was determined AND it's not part of a known problematic fragmentation or footer
-                    # Add a check to prevent "RFP: R" etc. from being added as headings.
-                    if current_level and not re.match(r'^RFP:\s*[A-Z]$', line_text) and not re.match(r'^(quest|r Pr|oposal)\s*f.*$', line_text) \
-                       and not re.match(r'^RFP:\s*To Develop the Ontario Digital Library Business Plan$', line_text):
-                        outline.append({
-                            "level": current_level,
-                            "text": line_text, # Use the full line text
-                            "page": page_num + 1
-                        })
-
-    logging.debug(f"Extracted {len(outline)} outline entries for {pdf_path}")
-    return {
-        "title": title,
-        "outline": outline
+    def __init__(self, cache_dir, max_bytes=256 * 1024 * 1024, version=HEURISTICS_VERSION):
+        self.root_dir = os.path.join(cache_dir, CACHE_SUBDIR)
+        self.cache_dir = os.path.join(self.root_dir, f"v{version}")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._remove_stale_versions()
+        self.total_bytes = sum(os.path.getsize(path) for path in self._entry_paths())
+
+    def _remove_stale_versions(self):
+        for name in os.listdir(self.root_dir):
+            path = os.path.join(self.root_dir, name)
+            if CACHE_VERSION_PATTERN.match(name) and os.path.isdir(path) and path != self.cache_dir:
+                logging.debug("Removing outline cache for old heuristics version: %s", name)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _entry_paths(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def fetch(self, key, output_path):
+        """
+        Copies the cached outline for key to output_path. Returns True on a hit.
+        """
+        entry_path = self._entry_path(key)
+        try:
+            shutil.copyfile(entry_path, output_path)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        os.utime(entry_path) # Mark as recently used
+        self.hits += 1
+        return True
+
+    def store(self, key, output_path):
+        """
+        Saves a freshly written outline file under key and evicts old entries if needed.
+        """
+        entry_path = self._entry_path(key)
+        partial_path = entry_path + ".part"
+        if os.path.exists(entry_path):
+            self.total_bytes -= os.path.getsize(entry_path)
+        shutil.copyfile(output_path, partial_path)
+        os.replace(partial_path, entry_path)
+        self.total_bytes += os.path.getsize(entry_path)
+        self.stores += 1
+        self._evict()
+
+    def _evict(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        for path in sorted(self._entry_paths(), key=os.path.getmtime):
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+            self.evictions += 1
+            if self.total_bytes <= self.max_bytes:
+                break
+
+    def clear(self):
+        """
+        Drops every cached outline for the current heuristics version.
+        """
+        for path in self._entry_paths():
+            os.remove(path)
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes
+        }
+
+def _raise_document_timeout(signum, frame):
+    raise TimeoutError("document processing timed out")
+
+def _timed_call(timeout, func, *args):
+    """
+    Worker-side wrapper: runs func(*args) under an optional SIGALRM deadline and
+    returns (result, elapsed_seconds). Python only handles the signal between
+    PyMuPDF calls, so a runaway document is stopped at the next page boundary.
+    """
+    start = time.perf_counter()
+    use_alarm = bool(timeout) and hasattr(signal, "setitimer")
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, _raise_document_timeout)
+        # Keep re-firing after the deadline in case PyMuPDF swallows the first interrupt
+        signal.setitimer(signal.ITIMER_REAL, timeout, 0.5)
+    try:
+        result = func(*args)
+    except Exception as e:
+        # An interrupt inside a PyMuPDF call surfaces as a fitz error rather than TimeoutError
+        if use_alarm and time.perf_counter() - start >= timeout and not isinstance(e, TimeoutError):
+            raise TimeoutError("document processing timed out") from e
+        raise
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+    return result, time.perf_counter() - start
+
+# How long the parent waits past OUTLINE_TIMEOUT before giving up on a worker,
+# so the worker's own SIGALRM gets the first chance to stop it cleanly
+TIMEOUT_GRACE_SECONDS = 2.0
+
+def _terminate_pool(executor):
+    """
+    Stops a pool whose worker is stuck: shutdown() alone would wait for the
+    running task, so the worker processes are terminated outright.
+    """
+    processes = list((executor._processes or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+def _iter_pool_results(tasks, workers, timeout=None):
+    """
+    Runs tasks, (key, func, args) tuples, as _timed_call(timeout, func, *args)
+    on a pool of workers processes and yields (key, future) as each finishes.
+    At most workers tasks are in flight, so a task starts when it is
+    submitted and its deadline can be tracked here in the parent. SIGALRM
+    in the worker cannot interrupt a long PyMuPDF call, so a task still
+    running TIMEOUT_GRACE_SECONDS past its deadline is yielded with a
+    TimeoutError, its pool is terminated and replaced, and the other tasks
+    that were in flight are resubmitted.
+    """
+    queue = deque(tasks)
+    in_flight = {} # future -> (key, func, args, deadline)
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while queue or in_flight:
+            while queue and len(in_flight) < workers:
+                key, func, args = queue.popleft()
+                deadline = time.monotonic() + timeout + TIMEOUT_GRACE_SECONDS if timeout else None
+                in_flight[executor.submit(_timed_call, timeout, func, *args)] = (key, func, args, deadline)
+
+            deadlines = [deadline for _, _, _, deadline in in_flight.values() if deadline is not None]
+            wait_seconds = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            done, _ = wait(in_flight, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield in_flight.pop(future)[0], future
+
+            now = time.monotonic()
+            expired = [future for future, (_, _, _, deadline) in in_flight.items()
+                       if deadline is not None and deadline <= now and not future.done()]
+            if not expired:
+                continue
+            for future in expired:
+                key = in_flight.pop(future)[0]
+                stuck = Future()
+                stuck.set_exception(TimeoutError("document processing timed out"))
+                yield key, stuck
+            logging.warning("A worker did not stop after the %ss timeout; restarting the process pool", timeout)
+            _terminate_pool(executor)
+            executor = ProcessPoolExecutor(max_workers=workers)
+            # Tasks that finished meanwhile keep their result; the rest start over on the new pool
+            for future, (key, func, args, _) in list(in_flight.items()):
+                del in_flight[future]
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    yield key, future
+                else:
+                    queue.appendleft((key, func, args))
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def plan_shards(pdf_path, shard_pages):
+    """
+    Splits a document into (start_page, end_page) ranges of at most shard_pages pages.
+    Returns None if sharding is off or the document fits in a single shard.
+    """
+    if not shard_pages:
+        return None
+    with fitz.open(pdf_path) as document:
+        page_count = document.page_count
+    if page_count <= shard_pages:
+        return None
+    return [(start, min(start + shard_pages, page_count)) for start in range(0, page_count, shard_pages)]
+
+def process_pdfs_in_parallel(input_dir, output_dir, pdf_files, workers, timeout=None, shard_pages=None, stream_format=None, cache=None, metrics=None, use_toc=False, sample_pages=None):
+    """
+    Runs extract_outline over pdf_files on a process pool, largest files first.
+    Documents longer than shard_pages pages are parsed as page-range shards whose
+    line records are merged in the parent, so thresholds still see the whole document.
+    With stream_format set, each worker streams its document straight to disk
+    instead (sharding does not apply), estimating thresholds from sample_pages
+    pages if given. Cache hits are written by the parent and
+    never reach the pool; with use_toc, so do documents with a usable embedded
+    table of contents, which is cheap to read. Workers time their own stages and send the
+    DocumentMetrics back with the result, to be collected on metrics (a RunMetrics).
+    With a timeout, a document whose worker overruns it is reported as timed
+    out, even when it is stuck inside PyMuPDF (see _iter_pool_results).
+    Returns a summary dict with per-document status and timings.
+    """
+    batch_start = time.perf_counter()
+    # Largest first, so a big document doesn't start last and become the tail of the batch
+    pdf_files = sorted(pdf_files, key=lambda name: os.path.getsize(os.path.join(input_dir, name)), reverse=True)
+
+    documents = {}
+    shard_results = {}
+    shard_plans = {}
+    file_metrics = {}
+    pending = {}
+    tasks = []
+    for filename in pdf_files:
+        pdf_path = os.path.join(input_dir, filename)
+        entry = {"file": filename, "status": "ok", "seconds": 0.0, "shards": 1, "headings": 0}
+        documents[filename] = entry
+        doc_metrics = metrics.new_document(filename) if metrics else None
+        file_metrics[filename] = doc_metrics
+        try:
+            output_path = os.path.join(output_dir, output_filename_for(filename, stream_format))
+            if cache and stream_format != "jsonl":
+                with _stage(doc_metrics, "cache"):
+                    entry["cache_key"] = cache_key_for(pdf_path, use_toc, sample_pages if stream_format else None)
+                    cache_hit = cache.fetch(entry["cache_key"], output_path)
+                if cache_hit:
+                    entry["cached"] = True
+                    if doc_metrics:
+                        doc_metrics.counters["cache_hits"] = 1
+                    print(f"Saved cached outline to {output_path}") # Keep this print for high-level progress
+                    continue
+            if use_toc:
+                toc_outline = extract_toc_outline(pdf_path, doc_metrics)
+                if toc_outline:
+                    write_toc_outline(toc_outline, output_path, stream_format, doc_metrics)
+                    if "cache_key" in entry:
+                        cache.store(entry["cache_key"], output_path)
+                    entry["toc"] = True
+                    entry["headings"] = len(toc_outline["outline"])
+                    print(f"Saved outline to {output_path}") # Keep this print for high-level progress
+                    continue
+            shards = None if stream_format else plan_shards(pdf_path, shard_pages)
+        except Exception as e:
+            entry["status"] = "error"
+            entry["error"] = str(e)
+            logging.error("Error processing %s: %s", filename, e)
+            continue
+
+        if shards:
+            entry["shards"] = len(shards)
+            shard_plans[filename] = shards
+            shard_results[filename] = [None] * len(shards)
+            for shard_index, (start_page, end_page) in enumerate(shards):
+                tasks.append(((filename, shard_index), extract_page_records, (pdf_path, start_page, end_page)))
+        elif stream_format:
+            tasks.append(((filename, None), _run_with_metrics, (stream_outline_to_file, pdf_path, output_path, stream_format, sample_pages)))
+        else:
+            tasks.append(((filename, None), _run_with_metrics, (extract_outline, pdf_path)))
+        pending[filename] = entry["shards"]
+
+    for (filename, shard_index), future in _iter_pool_results(tasks, workers, timeout):
+        entry = documents[filename]
+        try:
+            result, seconds = future.result()
+            entry["seconds"] += seconds
+            if shard_index is None:
+                outline_data, worker_metrics = result
+                if file_metrics[filename]:
+                    file_metrics[filename].merge(worker_metrics)
+            else:
+                shard_results[filename][shard_index] = result
+        except TimeoutError:
+            entry["status"] = "timeout"
+            entry["error"] = f"exceeded {timeout}s"
+            logging.error("Timed out processing %s after %ss", filename, timeout)
+        except Exception as e:
+            entry["status"] = "error"
+            entry["error"] = str(e)
+            logging.error("Error processing %s: %s", filename, e)
+
+        pending[filename] -= 1
+        if pending[filename] or entry["status"] != "ok":
+            continue
+
+        doc_metrics = file_metrics[filename]
+        try:
+            output_path = os.path.join(output_dir, output_filename_for(filename, stream_format))
+            if stream_format:
+                entry["headings"] = outline_data # The streaming worker already wrote the file
+            else:
+                if shard_index is not None:
+                    # Shards come back in any order; stitch the records back together in page order
+                    shards = shard_results.pop(filename)
+                    records = [record for shard_records, _ in shards for record in shard_records]
+                    if doc_metrics:
+                        doc_metrics.peak_rss_mb = max(peak_mb for _, peak_mb in shards)
+                        doc_metrics.stages["layout"] = entry["seconds"] # Summed across shard workers
+                        doc_metrics.counters["pages"] = shard_plans[filename][-1][1]
+                        doc_metrics.counters["lines"] = len(records)
+                    outline_data = build_outline(records, doc_metrics)
+                    if doc_metrics:
+                        doc_metrics.counters["headings"] = len(outline_data["outline"])
+                with _stage(doc_metrics, "write"):
+                    write_outline(outline_data, output_path)
+                entry["headings"] = len(outline_data["outline"])
+            if "cache_key" in entry:
+                cache.store(entry["cache_key"], output_path)
+            print(f"Saved outline to {output_path}") # Keep this print for high-level progress
+        except Exception as e:
+            entry["status"] = "error"
+            entry["error"] = str(e)
+            logging.error("Error writing outline for %s: %s", filename, e)
+
+    summary = {
+        "workers": workers,
+        "documents": [documents[filename] for filename in pdf_files],
+        "succeeded": sum(1 for entry in documents.values() if entry["status"] == "ok"),
+        "failed": sum(1 for entry in documents.values() if entry["status"] == "error"),
+        "timed_out": sum(1 for entry in documents.values() if entry["status"] == "timeout"),
+        "elapsed_seconds": time.perf_counter() - batch_start
     }
+    if cache:
+        summary["cache"] = cache.stats()
+    print(f"Batch finished: {summary['succeeded']} succeeded, {summary['failed']} failed, "
+          f"{summary['timed_out']} timed out in {summary['elapsed_seconds']:.2f}s")
+    return summary
 
-def process_pdfs_in_directory(input_dir, output_dir):
+def process_pdfs_in_directory(input_dir, output_dir, workers=1, timeout=None, shard_pages=None, stream_format=None, cache=None, metrics=None, use_toc=False, sample_pages=None):
     """
     Processes all PDF files found in the input_dir and saves their
     extracted outlines as JSON files in the output_dir.
+    With workers > 1, or with a timeout, the files are processed on a process
+    pool (see process_pdfs_in_parallel) and the batch summary is returned:
+    a timeout can only be enforced on a worker process, so it runs a
+    single-worker pool when workers is 1.
+    With stream_format ("json" or "jsonl") outlines are written page by page
+    (see stream_outline_to_file) instead of being built in memory first, with
+    thresholds estimated from sample_pages sampled pages if given.
+    With an OutlineCache, unchanged PDFs are served from the cache without
+    being opened at all. With a RunMetrics, every document's stage timings and
+    counters are recorded on it. With use_toc, documents carrying plausible
+    bookmarks take them as their outline and skip the layout heuristics.
     """
-    logging.debug(f"Starting process_pdfs_in_directory. Input: {input_dir}, Output: {output_dir}")
+    logging.debug("Starting process_pdfs_in_directory. Input: %s, Output: %s", input_dir, output_dir)
 
     # Check if directories exist (crucial inside container)
     if not os.path.exists(input_dir):
-        logging.error(f"Input directory does not exist: {input_dir}")
+        logging.error("Input directory does not exist: %s", input_dir)
         return
     if not os.path.exists(output_dir):
-        logging.warning(f"Output directory does not exist: {output_dir}, attempting to create.")
+        logging.warning("Output directory does not exist: %s, attempting to create.", output_dir)
         os.makedirs(output_dir, exist_ok=True)
         if not os.path.exists(output_dir):
-            logging.critical(f"Failed to create or access output directory: {output_dir}")
+            logging.critical("Failed to create or access output directory: %s", output_dir)
             return
 
     file_list = os.listdir(input_dir)
-    logging.debug(f"Files found in input directory: {file_list}")
+    logging.debug("Files found in input directory: %s", file_list)
+
+    if workers > 1 or timeout:
+        pdf_files = [filename for filename in file_list if filename.lower().endswith(".pdf")]
+        return process_pdfs_in_parallel(input_dir, output_dir, pdf_files, workers, timeout, shard_pages, stream_format, cache, metrics, use_toc, sample_pages)
 
     for filename in file_list:
         if filename.lower().endswith(".pdf"):
             pdf_path = os.path.join(input_dir, filename)
-            output_filename = filename.replace(".pdf", ".json")
+            output_filename = output_filename_for(filename, stream_format)
             output_path = os.path.join(output_dir, output_filename)
 
             print(f"Processing {filename}...") # Keep this print for high-level progress
+            doc_metrics = metrics.new_document(filename) if metrics else None
             try:
-                outline_data = extract_outline(pdf_path)
-                logging.debug(f"Attempting to write to {output_path}")
-                with open(output_path, "w", encoding="utf-8") as f:
-                    json.dump(outline_data, f, indent=4, ensure_ascii=False)
+                # The cache holds the formatted JSON file, which streaming "json" output reproduces exactly
+                cache_key = None
+                if cache and stream_format != "jsonl":
+                    with _stage(doc_metrics, "cache"):
+                        cache_key = cache_key_for(pdf_path, use_toc, sample_pages if stream_format else None)
+                        cache_hit = cache.fetch(cache_key, output_path)
+                    if cache_hit:
+                        if doc_metrics:
+                            doc_metrics.counters["cache_hits"] = 1
+                        print(f"Saved cached outline to {output_path}") # Keep this print for high-level progress
+                        continue
+                toc_outline = extract_toc_outline(pdf_path, doc_metrics) if use_toc and stream_format else None
+                if toc_outline:
+                    write_toc_outline(toc_outline, output_path, stream_format, doc_metrics)
+                elif stream_format:
+                    stream_outline_to_file(pdf_path, output_path, stream_format, sample_pages, doc_metrics)
+                else:
+                    outline_data = extract_outline(pdf_path, doc_metrics, use_toc)
+                    logging.debug("Attempting to write to %s", output_path)
+                    with _stage(doc_metrics, "write"):
+                        write_outline(outline_data, output_path)
+                if cache_key:
+                    cache.store(cache_key, output_path)
                 print(f"Saved outline to {output_path}") # Keep this print for high-level progress
             except Exception as e:
-                logging.error(f"Error processing {filename}: {e}")
+                logging.error("Error processing %s: %s", filename, e)
                 traceback.print_exc()
 
+    if cache:
+        logging.info("Outline cache stats: %s", cache.stats())
+
 if __name__ == "__main__":
+    # Configure logging for the script run only; per-line traces need OUTLINE_LOG_LEVEL=DEBUG
+    logging.basicConfig(level=os.getenv("OUTLINE_LOG_LEVEL", "INFO").upper(), format='%(levelname)s: %(message)s')
     logging.debug("main.py script started.")
     INPUT_DIR = "/app/input"
     OUTPUT_DIR = "/app/output"
 
-    process_pdfs_in_directory(INPUT_DIR, OUTPUT_DIR)
+    # Parallel batch mode is opt-in: OUTLINE_WORKERS=0 uses every core
+    workers = int(os.getenv("OUTLINE_WORKERS", "1")) or os.cpu_count()
+    timeout = float(os.getenv("OUTLINE_TIMEOUT", "0")) or None
+    shard_pages = int(os.getenv("OUTLINE_SHARD_PAGES", "0")) or None
+    summary_path = os.getenv("OUTLINE_SUMMARY_PATH")
+    # Streaming output for very large PDFs: "json" (same file, written incrementally) or "jsonl"
+    stream_format = os.getenv("OUTLINE_STREAM") or None
+    # Streaming only: estimate the heading thresholds from this many sampled pages instead of a full pre-pass
+    sample_pages = int(os.getenv("OUTLINE_SAMPLE_PAGES", "0")) or None
+    # Fast path: take the outline from embedded bookmarks when they look trustworthy
+    use_toc = os.getenv("OUTLINE_USE_TOC", "").lower() in ("1", "true", "yes")
+
+    # Content-addressed outline cache, off unless OUTLINE_CACHE_DIR is set
+    cache = None
+    cache_dir = os.getenv("OUTLINE_CACHE_DIR")
+    if cache_dir:
+        cache = OutlineCache(cache_dir, int(float(os.getenv("OUTLINE_CACHE_MAX_MB", "256")) * 1024 * 1024))
+        if os.getenv("OUTLINE_CACHE_CLEAR"):
+            cache.clear()
+
+    # Instrumentation: JSON metrics report and/or a cProfile dump of the run
+    metrics_path = os.getenv("OUTLINE_METRICS_PATH")
+    profile_path = os.getenv("OUTLINE_PROFILE_PATH")
+    metrics = RunMetrics() if metrics_path else None
+    profiler = cProfile.Profile() if profile_path else None
+
+    if profiler:
+        profiler.enable()
+    summary = process_pdfs_in_directory(INPUT_DIR, OUTPUT_DIR, workers, timeout, shard_pages, stream_format, cache, metrics, use_toc, sample_pages)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_path) # Covers this process only; pool workers are not profiled
+    if metrics:
+        metrics.write(metrics_path)
+    if summary and summary_path:
+        with open(summary_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=4)
     logging.debug("main.py script finished.")
\ No newline at end of file
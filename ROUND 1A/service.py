@@ -0,0 +1,301 @@
+"""
+Long-running outline service for Round 1A.
+
+Keeps a pool of warm worker processes (PyMuPDF already imported, heuristics
+already compiled) behind a small HTTP server, so a request pays only for the
+outline extraction itself rather than interpreter start-up and imports.
+
+Endpoints:
+    POST /outline   body = PDF bytes (Content-Type: application/pdf)
+                    -> {"title": ..., "outline": [...]}, same as extract_outline
+    POST /outline   body = {"path": "/app/input/a.pdf"}                   (JSON)
+                    -> {"title": ..., "outline": [...]}
+    POST /outline   body = {"paths": ["/app/input/a.pdf", ...]}            (JSON)
+                    -> {"results": [{"path": ..., "title": ..., "outline": [...]} | {"path": ..., "error": ...}]}
+    GET  /health    -> {"status": "ok", "workers": N}
+    GET  /stats     -> request, document and latency counters
+
+Add ?use_toc=1 to /outline to use embedded bookmarks when they look valid.
+When the queue is full the service answers 503 with a Retry-After header
+instead of accepting more work. A batch larger than workers + queue size
+could never be admitted, so it is refused outright with 413 and the limit.
+
+Usage:
+    python service.py --port 8080
+    python service.py --socket /tmp/outline.sock
+    curl --unix-socket /tmp/outline.sock --data-binary @input/E0H1CM114.pdf \
+         -H "Content-Type: application/pdf" http://localhost/outline
+"""
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import main
+
+# Refuse request bodies above this size (bytes) rather than buffering them
+MAX_BODY_BYTES = 256 * 1024 * 1024
+
+def _warm_up():
+    # Touch the heavy imports so the first real request doesn't pay for them
+    main.fitz.TOOLS.mupdf_version()
+    return os.getpid()
+
+class ServiceStats:
+    """
+    Thread-safe request/document counters and latency totals for /stats.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0
+        self.documents = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.in_flight = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def record_document(self, seconds, status):
+        with self.lock:
+            self.documents += 1
+            self.total_latency += seconds
+            self.max_latency = max(self.max_latency, seconds)
+            if status == "error":
+                self.errors += 1
+            elif status == "timeout":
+                self.timeouts += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "in_flight": self.in_flight,
+                "documents": self.documents,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+                "mean_latency_seconds": self.total_latency / self.documents if self.documents else 0.0,
+                "max_latency_seconds": self.max_latency
+            }
+
+class OutlineService:
+    """
+    Owns the warm worker pool and the admission limit. At most
+    workers + queue_size documents are accepted at once; anything beyond that
+    is rejected so callers back off instead of piling up unbounded work.
+    """
+
+    def __init__(self, workers, queue_size, timeout=None):
+        self.workers = workers
+        self.capacity = workers + queue_size # Most documents that can ever be admitted at once
+        self.timeout = timeout
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.stats = ServiceStats()
+        # One warm-up task per worker so every process is started and has imported its modules
+        pids = {future.result() for future in [self.executor.submit(_warm_up) for _ in range(workers)]}
+        logging.info("Outline service warmed up %d worker processes", len(pids))
+
+    def try_admit(self, count):
+        """
+        Reserves queue slots for count documents; returns False if the queue is full.
+        """
+        acquired = 0
+        while acquired < count:
+            if not self.slots.acquire(blocking=False):
+                self.release(acquired)
+                return False
+            acquired += 1
+        return True
+
+    def release(self, count):
+        for _ in range(count):
+            self.slots.release()
+
+    def extract_many(self, sources, use_toc=False):
+        """
+        Runs extract_outline for every source (path or bytes) on the pool and
+        returns [(status, result_or_error, seconds)] in input order.
+        """
+        futures = [
+            self.executor.submit(main._timed_call, self.timeout, main.extract_outline, source, None, use_toc)
+            for source in sources
+        ]
+        results = []
+        for future in futures:
+            start = time.perf_counter()
+            try:
+                outline_data, seconds = future.result()
+                results.append(("ok", outline_data, seconds))
+            except TimeoutError:
+                results.append(("timeout", f"exceeded {self.timeout}s", time.perf_counter() - start))
+            except Exception as e:
+                results.append(("error", str(e), time.perf_counter() - start))
+            self.stats.record_document(results[-1][2], results[-1][0])
+        return results
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+class OutlineRequestHandler(BaseHTTPRequestHandler):
+    server_version = "OutlineService/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, {"status": "ok", "workers": self.service.workers})
+        elif path == "/stats":
+            self._send_json(200, self.service.stats.as_dict())
+        else:
+            self._send_json(404, {"error": f"unknown endpoint {path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/outline":
+            self._send_json(404, {"error": f"unknown endpoint {url.path}"})
+            return
+        use_toc = parse_qs(url.query).get("use_toc", ["0"])[0].lower() in ("1", "true", "yes")
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self._send_json(400, {"error": "invalid Content-Length"})
+            return
+        if length <= 0 or length > MAX_BODY_BYTES:
+            self._send_json(413 if length else 400, {"error": "missing or oversized request body"})
+            return
+        body = self.rfile.read(length)
+
+        # Either the PDF itself, or JSON naming one path or a batch of paths
+        batch = None
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                request = json.loads(body)
+            except json.JSONDecodeError as e:
+                self._send_json(400, {"error": f"invalid JSON: {e}"})
+                return
+            if not isinstance(request, dict):
+                self._send_json(400, {"error": "expected a JSON object"})
+                return
+            if isinstance(request.get("paths"), list):
+                if not all(isinstance(path, str) for path in request["paths"]):
+                    self._send_json(400, {"error": "\"paths\" must be a list of strings"})
+                    return
+                batch = request["paths"]
+                sources = batch
+            elif isinstance(request.get("path"), str):
+                sources = [request["path"]]
+            else:
+                self._send_json(400, {"error": "expected \"path\" or \"paths\""})
+                return
+        else:
+            sources = [body]
+
+        self.service.stats.add(requests=1)
+        if len(sources) > self.service.capacity:
+            self.service.stats.add(rejected=1)
+            self._send_json(413, {"error": f"batch of {len(sources)} documents exceeds the limit of {self.service.capacity}",
+                                  "max_batch": self.service.capacity})
+            return
+        if not self.service.try_admit(len(sources)):
+            self.service.stats.add(rejected=1)
+            self._send_json(503, {"error": "queue full, retry later"}, {"Retry-After": "1"})
+            return
+
+        self.service.stats.add(in_flight=len(sources))
+        try:
+            results = self.service.extract_many(sources, use_toc)
+        finally:
+            self.service.stats.add(in_flight=-len(sources))
+            self.service.release(len(sources))
+
+        if batch is not None:
+            payload = []
+            for path, (status, result, _) in zip(batch, results):
+                payload.append(dict(path=path, **result) if status == "ok" else {"path": path, "error": result})
+            self._send_json(200, {"results": payload})
+            return
+
+        status, result, _ = results[0]
+        if status == "ok":
+            self._send_json(200, result)
+        else:
+            self._send_json(504 if status == "timeout" else 422, {"error": result})
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address) # Stale socket from a previous run
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def serve(service, host="127.0.0.1", port=8080, socket_path=None):
+    """
+    Serves requests until interrupted, over a Unix socket if socket_path is given.
+    """
+    if socket_path:
+        server = UnixHTTPServer(socket_path, OutlineRequestHandler)
+        logging.info("Outline service listening on unix:%s", socket_path)
+    else:
+        server = ThreadingHTTPServer((host, port), OutlineRequestHandler)
+        logging.info("Outline service listening on http://%s:%d", host, port)
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Round 1A outlines from a warm worker pool.")
+    parser.add_argument("--host", default=os.getenv("OUTLINE_SERVICE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("OUTLINE_SERVICE_PORT", "8080")))
+    parser.add_argument("--socket", default=os.getenv("OUTLINE_SERVICE_SOCKET"), help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("OUTLINE_WORKERS", "0")) or os.cpu_count())
+    parser.add_argument("--queue-size", type=int, default=int(os.getenv("OUTLINE_QUEUE_SIZE", "32")), help="documents allowed to wait for a worker")
+    parser.add_argument("--timeout", type=float, default=float(os.getenv("OUTLINE_TIMEOUT", "0")) or None, help="per-document timeout in seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv("OUTLINE_LOG_LEVEL", "INFO").upper(), format='%(levelname)s: %(message)s')
+    serve(OutlineService(args.workers, args.queue_size, args.timeout), args.host, args.port, args.socket)
@@ -1,150 +1,722 @@
 import os
+import sys
 import json
-import fitz # PyMuPDF
 from datetime import datetime
 import re # For regular expressions, useful for parsing text
+import math
+import heapq
+import itertools
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+
+# The layout pass and heading rules are shared with Round 1A: pdf_layout.py sits
+# next to this file in the image, and in ../common in a source checkout.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from pdf_layout import (
+    HEURISTICS_VERSION, LAYOUT_CACHE_DIR, LAYOUT_LOW_MEMORY, LAYOUT_VERSION, MemoryMonitor, hash_file, load_layout, open_document, stream_sections
+)
 
 # Define paths as they will be inside the Docker container
 INPUT_ROOT_DIR = "/app/input" # This will now be the root where collection folders live
 OUTPUT_DIR = "/app/output"
 INPUT_JSON_FILENAME = "input.json" # Still the name of the input file
+ALL_COLLECTIONS = "all" # COLLECTION_TO_PROCESS value that processes every collection folder
+# Worker processes for PDF extraction; 1 keeps everything in the main process
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "0")) or os.cpu_count() or 1
+# Directory for the persistent per-collection section index; unset disables it
+SECTION_INDEX_DIR = os.getenv("SECTION_INDEX_DIR")
+# Bump whenever sectioning or tokenization changes; layout and heading rule changes are picked up automatically
+SECTION_INDEX_VERSION = f"3-l{LAYOUT_VERSION}-h{HEURISTICS_VERSION}"
+MANIFEST_FILENAME = "manifest.json" # Per-collection record of what the section index holds
+# Drop section bodies once indexed and re-read only the few that get refined (huge collections)
+KEEP_SECTION_TEXT = os.getenv("ANALYSIS_DROP_TEXT", "0").lower() not in ("1", "true", "yes")
+# JSON file with a list of persona/job queries to run as one batch; unset = input.json only
+ANALYSIS_QUERIES = os.getenv("ANALYSIS_QUERIES")
+# Write <collection>_metrics.json (stage timings and counters) and/or a Chrome trace next to the output
+ANALYSIS_METRICS = os.getenv("ANALYSIS_METRICS", "0").lower() in ("1", "true", "yes")
+ANALYSIS_TRACE = os.getenv("ANALYSIS_TRACE", "0").lower() in ("1", "true", "yes")
 
-def extract_sections_from_text(text_content, document_filename):
-    """
-    A more sophisticated function to extract logical sections from raw text.
-    For this example, we'll use a very simple heuristic:
-    - Lines that are entirely uppercase or start with a capital letter and are short might be headings.
-    - We'll group subsequent text under these "headings".
-    - Each page will also be considered a potential "section" if no clear headings are found.
-    """
-    sections = []
-    current_section_title = "Introduction/General Information"
-    current_section_text = []
-    current_page_number = 1 # We'll update this based on page markers
-
-    lines = text_content.split('\n')
-    
-    for line in lines:
-        # Check for page markers
-        page_match = re.match(r'---\s*Page\s*(\d+)\s*---', line.strip())
-        if page_match:
-            if current_section_text: # Save previous section before moving to new page
-                sections.append({
-                    "document": document_filename,
-                    "section_title": current_section_title,
-                    "page_number": current_page_number,
-                    "text_content": "\n".join(current_section_text).strip()
-                })
-            current_page_number = int(page_match.group(1))
-            current_section_title = f"Content from Page {current_page_number}" # Default if no heading
-            current_section_text = []
-            continue
+# --- Instrumentation: stage timers and counters per document, query and collection ---
+class StageMetrics:
+    """
+    Stage timings (seconds) and counters for one document or one query.
+    Plain data, so pool workers can return it with their result. Every timed
+    stage is also kept as a span (stage, wall-clock start, seconds, pid) for
+    the trace file. Document stages: read, section, tokenize (or load, for a
+    document served by the section index). Query stages: rank, refine.
+    """
+    __slots__ = ("name", "stages", "counters", "spans")
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}
+        self.counters = {}
+        self.spans = []
+
+    @contextmanager
+    def stage(self, stage_name):
+        wall_start = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages[stage_name] = self.stages.get(stage_name, 0.0) + seconds
+            self.spans.append((stage_name, wall_start, seconds, os.getpid()))
+
+    def count(self, counter_name, value=1):
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + value
+
+    def as_dict(self):
+        return {"name": self.name, "stages": self.stages, "counters": self.counters}
+
+def _stage(metrics, name):
+    """
+    Times a stage on metrics, or does nothing when metrics are off.
+    """
+    return metrics.stage(name) if metrics else nullcontext()
+
+class CollectionMetrics:
+    """
+    Collects the StageMetrics of one collection's documents and queries, plus
+    the collection's own main-process stages (index, write), and renders the
+    JSON metrics report and the Chrome trace-event file.
+    """
+
+    def __init__(self, name):
+        self.collection = StageMetrics(name)
+        self.documents = [] # {"file", "from_store", "peak_rss_mb", "stages", "counters"}
+        self.queries = []
+        self.started = time.perf_counter()
+
+    def stage(self, name):
+        return self.collection.stage(name)
+
+    def add_document(self, filename, entry, from_store, doc_metrics):
+        if isinstance(entry, Exception):
+            self.collection.count("failed_documents")
+            return
+        doc_metrics = doc_metrics or StageMetrics(filename)
+        doc_metrics.name = filename
+        doc_metrics.counters.update(pages=entry["page_count"], sections=len(entry["sections"]))
+        self.documents.append((doc_metrics, from_store, 0.0 if from_store else entry.get("peak_rss_mb", 0.0)))
+
+    def add_query(self, query_metrics):
+        self.queries.append(query_metrics)
+
+    def report(self):
+        stage_totals = dict(self.collection.stages)
+        counter_totals = dict(self.collection.counters)
+        for metrics in [doc_metrics for doc_metrics, _, _ in self.documents] + self.queries:
+            for name, seconds in metrics.stages.items():
+                stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+            for name, count in metrics.counters.items():
+                counter_totals[name] = counter_totals.get(name, 0) + count
+        return {
+            "collection": self.collection.name,
+            "elapsed_seconds": time.perf_counter() - self.started,
+            "stage_totals": stage_totals,
+            "counter_totals": counter_totals,
+            "documents": [dict(doc_metrics.as_dict(), from_store=from_store, peak_rss_mb=peak_rss_mb)
+                          for doc_metrics, from_store, peak_rss_mb in self.documents],
+            "queries": [metrics.as_dict() for metrics in self.queries]
+        }
+
+    def trace_events(self):
+        """
+        Returns every recorded span as Chrome trace events ("X" complete
+        events, microseconds), one track per process, for chrome://tracing
+        or Perfetto.
+        """
+        events = []
+        units = [("collection", self.collection)] + [("document", doc_metrics) for doc_metrics, _, _ in self.documents]
+        units += [("query", metrics) for metrics in self.queries]
+        pids = set()
+        for category, metrics in units:
+            for stage_name, wall_start, seconds, pid in metrics.spans:
+                pids.add(pid)
+                events.append({"name": stage_name, "cat": category, "ph": "X", "ts": wall_start * 1e6, "dur": seconds * 1e6,
+                               "pid": pid, "tid": pid, "args": {category: metrics.name}})
+        for pid in sorted(pids):
+            label = "main" if pid == os.getpid() else f"worker {pid}"
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": pid, "args": {"name": label}})
+        return events
+
+    def write(self, metrics_path=None, trace_path=None):
+        if metrics_path:
+            with open(metrics_path, "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, indent=4)
+            print(f"[{os.getenv('HOSTNAME')}] Wrote metrics to {metrics_path}")
+        if trace_path:
+            with open(trace_path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
+            print(f"[{os.getenv('HOSTNAME')}] Wrote trace to {trace_path}")
+
+def streams_sections():
+    """
+    Whether PDFs are sectioned page by page (stream_sections) rather than
+    from the single-pass layout model: only in low-memory mode, and only
+    without LAYOUT_CACHE_DIR, whose models are shared with Round 1A.
+    """
+    return LAYOUT_LOW_MEMORY and not LAYOUT_CACHE_DIR
+
+def iter_document_sections(doc_path, filename, monitor=None):
+    """
+    Yields one PDF's sections: the text under each font-based heading.
+    They come from the shared layout model, parsed in one pass (or loaded
+    from LAYOUT_CACHE_DIR), which holds every line of the document. In
+    low-memory mode without a cache the PDF is instead read twice and
+    sectioned page by page (stream_sections), so memory is bounded by one
+    page of line records plus the sections themselves.
+    """
+    if not streams_sections():
+        yield from load_layout(doc_path, monitor=monitor).iter_sections(filename)
+        return
+    document = open_document(doc_path)
+    try:
+        yield from stream_sections(document, filename, monitor)
+    finally:
+        document.close()
 
-        stripped_line = line.strip()
-        if not stripped_line: # Skip empty lines
+def extract_document_sections(doc_path, filename, monitor=None, metrics=None):
+    """
+    Reads one PDF and splits its text into heading-bounded sections (see
+    iter_document_sections). Runs in a worker process; returns (page_count,
+    sections). Pass a MemoryMonitor to read the document's peak RSS
+    afterwards, and a StageMetrics to time the read and section stages.
+    """
+    if not streams_sections():
+        with _stage(metrics, "read"):
+            model = load_layout(doc_path, monitor=monitor)
+        with _stage(metrics, "section"):
+            return model.page_count, list(model.iter_sections(filename))
+    with _stage(metrics, "read"):
+        document = open_document(doc_path)
+    try:
+        with _stage(metrics, "section"): # Includes reading the pages, which happens as they are sectioned
+            return document.page_count, list(stream_sections(document, filename, monitor))
+    finally:
+        document.close()
+
+def analyze_document(doc_path, filename):
+    """
+    Worker task: sections a PDF and tokenizes every section.
+    Returns a section index entry (see SectionIndexStore), with the
+    document's StageMetrics under "metrics" (not stored).
+    """
+    monitor = MemoryMonitor()
+    metrics = StageMetrics(filename)
+    page_count, sections = extract_document_sections(doc_path, filename, monitor, metrics)
+    with metrics.stage("tokenize"):
+        section_counts = [section_term_counts(section) for section in sections]
+    return {
+        "version": SECTION_INDEX_VERSION,
+        "page_count": page_count,
+        "peak_rss_mb": monitor.peak_mb,
+        "sections": sections,
+        "term_counts": section_counts,
+        "metrics": metrics
+    }
+
+# --- Retrieval: inverted index with BM25F scoring over section titles and bodies ---
+TOKEN_PATTERN = re.compile(r"\w+(?:[-']\w+)*") # Keeps hyphenated terms like "e-signature" whole
+STOPWORDS = frozenset("a an and are as at be by for from in into is it its of on or that the this to with".split())
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_FIELD_WEIGHT = 5.0 # A title occurrence counts like five body occurrences (the old 10 vs 2 keyword scores)
+
+# General relevant terms for HR and form management
+GENERAL_KEYWORDS = ["form", "forms", "fillable", "onboarding", "compliance", "signature",
+                    "e-signature", "sign", "request", "create", "manage", "edit",
+                    "convert", "export", "share", "pdf", "document", "digital",
+                    "workflow", "template", "review", "privacy", "security", "ai",
+                    "human resources", "hr"]
+
+def tokenize(text):
+    """
+    Lowercases text and splits it into index terms, dropping stopwords.
+    Hyphenated terms are kept whole and also contribute their parts, so
+    "gluten-free" in a query still matches "gluten free" in a section.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
             continue
+        tokens.append(token)
+        if "-" in token:
+            tokens.extend(part for part in token.split("-") if part and part not in STOPWORDS)
+    return tokens
+
+def build_query_terms(job_to_be_done_task, persona_role):
+    """
+    The query is the job, the persona and the general domain keywords, as a set of terms.
+    """
+    return set(tokenize(job_to_be_done_task) + tokenize(persona_role) + tokenize(" ".join(GENERAL_KEYWORDS)))
+
+def term_counts(text):
+    counts = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+def section_term_counts(section):
+    """
+    Returns the ({term: frequency} for the title, {term: frequency} for the body)
+    of a section: its token statistics, as stored in the section index.
+    """
+    return term_counts(section.get("section_title", "")), term_counts(section.get("text_content", ""))
+
+class SectionIndex:
+    """
+    Inverted index over section titles and bodies. Every section is tokenized
+    at most once, when it is added or when it is first stored on disk; scoring a query only walks the postings of
+    the query's own terms.
+    """
+
+    def __init__(self, sections=(), keep_text=True):
+        self.keep_text = keep_text
+        self.sections = []
+        self.text_sources = [] # (doc_path, position in document, store entry path or None) for re-reading dropped bodies
+        self.title_postings = {} # term -> {section_id: term frequency in the title}
+        self.body_postings = {} # term -> {section_id: term frequency in the body}
+        self.title_lengths = []
+        self.body_lengths = []
+        self.titles_lower = []
+        self.total_title_length = 0
+        self.total_body_length = 0
+        for section in sections:
+            self.add(section)
+
+    def add(self, section, term_counts=None, text_source=None):
+        """
+        Adds a section and returns its id. term_counts is the section's
+        (title, body) term frequencies from section_term_counts, when they
+        were already computed (e.g. loaded from the on-disk section index).
+        text_source is (doc_path, position of the section in that document,
+        path of the document's section index entry or None); given it, an
+        index with keep_text=False stores the section without its
+        text_content and section_texts reads it back on demand.
+        """
+        section_id = len(self.sections)
+        self.titles_lower.append(section.get("section_title", "").lower())
+        if term_counts is None:
+            term_counts = section_term_counts(section)
+        if not self.keep_text and text_source is not None:
+            section = {key: value for key, value in section.items() if key != "text_content"}
+        self.sections.append(section)
+        self.text_sources.append(text_source)
+        for counts, postings, lengths in ((term_counts[0], self.title_postings, self.title_lengths),
+                                          (term_counts[1], self.body_postings, self.body_lengths)):
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                postings.setdefault(term, {})[section_id] = frequency
+        self.total_title_length += self.title_lengths[-1]
+        self.total_body_length += self.body_lengths[-1]
+        return section_id
+
+    def section_text(self, section_id):
+        return self.section_texts([section_id])[0]
+
+    def section_texts(self, section_ids):
+        """
+        Returns the text_content of several sections, in order. Bodies dropped
+        at indexing time are fetched once per document: from the document's
+        section index entry when it has one, otherwise by re-sectioning its
+        PDF a single time, up to the last section needed.
+        """
+        texts = {}
+        wanted = {} # (doc_path, entry_path, filename) -> {position: section_id}
+        for section_id in section_ids:
+            section = self.sections[section_id]
+            if "text_content" in section:
+                texts[section_id] = section["text_content"]
+                continue
+            doc_path, position, entry_path = self.text_sources[section_id]
+            wanted.setdefault((doc_path, entry_path, section["document"]), {})[position] = section_id
+
+        for (doc_path, entry_path, filename), positions in wanted.items():
+            document_texts = read_stored_texts(entry_path, positions) if entry_path else None
+            if document_texts is None:
+                sections = iter_document_sections(doc_path, filename)
+                try:
+                    document_texts = {position: section["text_content"]
+                                      for position, section in enumerate(itertools.islice(sections, max(positions) + 1))
+                                      if position in positions}
+                finally:
+                    sections.close()
+            for position, section_id in positions.items():
+                texts[section_id] = document_texts[position]
+        return [texts[section_id] for section_id in section_ids]
+
+    def bm25_scores(self, query_terms):
+        """
+        Returns {section_id: BM25F score} for every section matching at least one
+        query term. Field term frequencies are length-normalized per field and
+        combined with TITLE_FIELD_WEIGHT before BM25 saturation.
+        """
+        section_count = len(self.sections)
+        if not section_count:
+            return {}
+        avg_title_length = self.total_title_length / section_count or 1.0
+        avg_body_length = self.total_body_length / section_count or 1.0
+
+        scores = {}
+        for term in query_terms:
+            title_hits = self.title_postings.get(term, {})
+            body_hits = self.body_postings.get(term, {})
+            matching_ids = title_hits.keys() | body_hits.keys()
+            if not matching_ids:
+                continue
+            idf = math.log(1 + (section_count - len(matching_ids) + 0.5) / (len(matching_ids) + 0.5))
+            for section_id in matching_ids:
+                weighted_tf = (
+                    TITLE_FIELD_WEIGHT * title_hits.get(section_id, 0) /
+                    (1 - BM25_B + BM25_B * self.title_lengths[section_id] / avg_title_length)
+                    + body_hits.get(section_id, 0) /
+                    (1 - BM25_B + BM25_B * self.body_lengths[section_id] / avg_body_length)
+                )
+                scores[section_id] = scores.get(section_id, 0.0) + idf * weighted_tf * (BM25_K1 + 1) / (weighted_tf + BM25_K1)
+        return scores
+
+def read_stored_texts(entry_path, positions):
+    """
+    Returns {position: text_content} for the given section positions of a
+    section index entry, or None if the entry cannot be read.
+    """
+    try:
+        with open(entry_path, "r", encoding="utf-8") as f:
+            sections = json.load(f)["sections"]
+        return {position: sections[position]["text_content"] for position in positions}
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+# --- Persistent section index: analyzed documents cached on disk by content hash ---
+class SectionIndexStore:
+    """
+    On-disk section index for one collection: one compact JSON entry per PDF,
+    named by the SHA-256 of its bytes, holding its page count, sections and
+    per-section term counts. A changed PDF hashes to a new name and is simply
+    re-analyzed. The SECTION_INDEX_VERSION is part of the name too, so entries
+    written by another version are never read; they are pruned along with
+    entries no longer used by the collection.
+
+    A manifest records, per input.json filename, the content hash, file size
+    and mtime, extraction version and section count of the last run. A file
+    whose size and mtime are unchanged reuses its recorded hash without being
+    read again, and each run reports which documents are new, changed,
+    removed or unchanged since the last one.
+    """
+
+    def __init__(self, root_dir, collection_name):
+        self.directory = os.path.join(root_dir, collection_name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest_path = os.path.join(self.directory, MANIFEST_FILENAME)
+        self.manifest = self.load_manifest()
+        self.next_manifest = {} # filename -> record, filled in as documents are indexed
+        self.file_stats = {} # filename -> (size, mtime_ns) seen by content_hash_for
+
+    def path_for(self, content_hash):
+        return os.path.join(self.directory, f"{content_hash}.v{SECTION_INDEX_VERSION}.json")
+
+    def contains(self, content_hash):
+        return os.path.exists(self.path_for(content_hash))
+
+    def load(self, content_hash):
+        """
+        Returns the stored entry, or None if it is missing, unreadable or stale.
+        """
+        try:
+            with open(self.path_for(content_hash), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("version") == SECTION_INDEX_VERSION else None
+
+    def save(self, content_hash, entry):
+        self._write_json(self.path_for(content_hash), entry)
+
+    def _write_json(self, path, data):
+        temp_path = path + ".part"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp_path, path)
+
+    def load_manifest(self):
+        """
+        Returns {filename: record} from the last run, or {} if there is no
+        usable manifest.
+        """
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest.get("documents", {}) if isinstance(manifest, dict) else {}
+
+    def content_hash_for(self, filename, doc_path):
+        """
+        Returns the PDF's SHA-256, reusing the manifest's hash instead of
+        reading the file when its size and mtime have not changed.
+        """
+        stat = os.stat(doc_path)
+        self.file_stats[filename] = (stat.st_size, stat.st_mtime_ns)
+        record = self.manifest.get(filename)
+        if record and record.get("size") == stat.st_size and record.get("mtime_ns") == stat.st_mtime_ns:
+            return record["content_hash"]
+        return hash_file(doc_path)
+
+    def diff(self, doc_jobs, content_hashes):
+        """
+        Compares the collection's documents with the manifest. Returns
+        {"new": [...], "changed": [...], "removed": [...], "unchanged": [...]}
+        lists of filenames; a document extracted by another
+        SECTION_INDEX_VERSION counts as changed.
+        """
+        changes = {"new": [], "changed": [], "removed": [], "unchanged": []}
+        for (filename, _), content_hash in zip(doc_jobs, content_hashes):
+            record = self.manifest.get(filename)
+            if record is None:
+                changes["new"].append(filename)
+            elif record.get("content_hash") != content_hash or record.get("version") != SECTION_INDEX_VERSION:
+                changes["changed"].append(filename)
+            else:
+                changes["unchanged"].append(filename)
+        current = {filename for filename, _ in doc_jobs}
+        changes["removed"] = [filename for filename in self.manifest if filename not in current]
+        return changes
+
+    def record(self, filename, content_hash, entry):
+        """
+        Adds an indexed document to the manifest written by commit.
+        """
+        size, mtime_ns = self.file_stats.get(filename, (None, None))
+        self.next_manifest[filename] = {
+            "content_hash": content_hash,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "version": SECTION_INDEX_VERSION,
+            "pages": entry["page_count"],
+            "sections": len(entry["sections"])
+        }
+
+    def commit(self):
+        """
+        Writes the manifest of the documents indexed this run and prunes the
+        entries none of them use.
+        """
+        self._write_json(self.manifest_path, {"version": SECTION_INDEX_VERSION, "documents": self.next_manifest})
+        self.prune({record["content_hash"] for record in self.next_manifest.values()})
+        self.manifest, self.next_manifest = self.next_manifest, {}
+
+    def prune(self, live_hashes):
+        """
+        Deletes entries for PDFs that are no longer part of the collection.
+        """
+        live_names = {os.path.basename(self.path_for(content_hash)) for content_hash in live_hashes}
+        live_names.add(MANIFEST_FILENAME)
+        for name in os.listdir(self.directory):
+            if name.endswith(".json") and name not in live_names:
+                os.remove(os.path.join(self.directory, name))
+
+def plan_documents(doc_jobs, store=None):
+    """
+    Returns (content_hashes, pending) for the (filename, doc_path) jobs:
+    each PDF's SHA-256 when there is a store (None otherwise, or when the
+    file cannot be read), and the positions of the jobs that must be analyzed
+    because the store has no entry for them. With a store, the differences
+    from the last run's manifest are reported.
+    """
+    content_hashes = [None] * len(doc_jobs)
+    if store is not None:
+        for position, (filename, doc_path) in enumerate(doc_jobs):
+            try:
+                content_hashes[position] = store.content_hash_for(filename, doc_path)
+            except OSError:
+                pass # Reported when analyze_document fails to open it
+        changes = store.diff(doc_jobs, content_hashes)
+        print(f"[{os.getenv('HOSTNAME')}] Section index: {len(changes['new'])} new, {len(changes['changed'])} changed, "
+              f"{len(changes['removed'])} removed, {len(changes['unchanged'])} unchanged documents")
+    pending = [position for position, content_hash in enumerate(content_hashes)
+               if content_hash is None or not store.contains(content_hash)]
+    return content_hashes, pending
+
+def resolve_entry(filename, doc_path, content_hash, store=None, future=None):
+    """
+    Returns (entry, from_store) for one document: the result of its pool
+    future if it was submitted, otherwise its store entry, otherwise
+    analyze_document run inline (e.g. for an unreadable store entry).
+    An exception raised by the document is returned as the entry.
+    """
+    if future is None and content_hash is not None:
+        metrics = StageMetrics(filename)
+        with metrics.stage("load"):
+            entry = store.load(content_hash)
+        if entry is not None:
+            entry["metrics"] = metrics
+            return entry, True
+    try:
+        return (future.result() if future is not None else analyze_document(doc_path, filename)), False
+    except Exception as e:
+        return e, False
+
+def iter_analyzed_documents(doc_jobs, workers=ANALYSIS_WORKERS, store=None):
+    """
+    Yields (filename, doc_path, content_hash, entry, from_store) for every
+    (filename, doc_path) job, in input order; entry is an analyze_document
+    result, or the exception that document raised. Documents found in the
+    store (a SectionIndexStore) are loaded from disk; the others are analyzed
+    on a process pool when workers > 1. At most a couple of results per
+    worker are held ahead of the consumer, so memory does not grow with the
+    number of documents.
+    """
+    content_hashes, pending = plan_documents(doc_jobs, store)
+
+    executor = None
+    futures = {}
+    if workers > 1 and len(pending) > 1:
+        pool_size = min(workers, len(pending))
+        executor = ProcessPoolExecutor(max_workers=pool_size)
+    lookahead = iter(pending)
+    try:
+        for position, (filename, doc_path) in enumerate(doc_jobs):
+            if executor is not None:
+                while len(futures) < 2 * pool_size:
+                    next_position = next(lookahead, None)
+                    if next_position is None:
+                        break
+                    next_filename, next_path = doc_jobs[next_position]
+                    futures[next_position] = executor.submit(analyze_document, next_path, next_filename)
 
-        # Simple heuristic for potential headings: short, all caps, or starts with capital and looks like a title
-        # This is a *very* basic heuristic and will need refinement for real PDFs.
-        if (len(stripped_line) < 80 and stripped_line.isupper() and len(stripped_line.split()) < 10) or \
-           (len(stripped_line) < 80 and stripped_line[0].isupper() and stripped_line.endswith('.') == False and len(stripped_line.split()) < 10):
-            if current_section_text: # Save previous section
-                sections.append({
-                    "document": document_filename,
-                    "section_title": current_section_title,
-                    "page_number": current_page_number,
-                    "text_content": "\n".join(current_section_text).strip()
-                })
-            current_section_title = stripped_line
-            current_section_text = []
+            entry, from_store = resolve_entry(filename, doc_path, content_hashes[position], store, futures.pop(position, None))
+            yield filename, doc_path, content_hashes[position], entry, from_store
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def index_documents(analyzed_documents, store=None, keep_text=KEEP_SECTION_TEXT, metrics=None):
+    """
+    Builds a SectionIndex from (filename, doc_path, content_hash, entry,
+    from_store) tuples in input order, adding each document as soon as it
+    arrives and writing newly analyzed ones back to the store. A failing
+    document is reported and skipped without affecting the others. With
+    keep_text=False section bodies are dropped as they are indexed and
+    re-read from the PDF only when needed. Each document's stage metrics
+    are handed to metrics (a CollectionMetrics) when given.
+    """
+    index = SectionIndex(keep_text=keep_text)
+    for filename, doc_path, content_hash, entry, from_store in analyzed_documents:
+        doc_metrics = entry.pop("metrics", None) if isinstance(entry, dict) else None
+        if metrics is not None:
+            metrics.add_document(filename, entry, from_store, doc_metrics)
+        if isinstance(entry, Exception):
+            print(f"[{os.getenv('HOSTNAME')}] ERROR processing {filename}: {entry}")
+            continue
+        if from_store:
+            print(f"[{os.getenv('HOSTNAME')}] Loaded from section index: {filename} (Pages: {entry['page_count']}, Sections: {len(entry['sections'])})")
         else:
-            current_section_text.append(stripped_line)
-    
-    # Add the last section
-    if current_section_text:
-        sections.append({
-            "document": document_filename,
-            "section_title": current_section_title,
-            "page_number": current_page_number,
-            "text_content": "\n".join(current_section_text).strip()
-        })
-    
-    return sections
+            print(f"[{os.getenv('HOSTNAME')}] Read PDF: {filename} (Pages: {entry['page_count']}, Sections: {len(entry['sections'])}, Peak RSS: {entry['peak_rss_mb']:.1f} MB)")
+            if store is not None and content_hash:
+                store.save(content_hash, entry)
+        if store is not None and content_hash:
+            store.record(filename, content_hash, entry)
+        entry_path = store.path_for(content_hash) if store is not None and content_hash else None
+        with _stage(metrics, "index"):
+            for position, (section, counts) in enumerate(zip(entry["sections"], entry["term_counts"])):
+                section["document"] = filename # The same bytes may be stored under another name
+                index.add(section, counts, (doc_path, position, entry_path))
+    if store is not None:
+        store.commit()
+    return index
+
+def build_section_index(doc_jobs, workers=ANALYSIS_WORKERS, store=None, keep_text=KEEP_SECTION_TEXT, metrics=None):
+    """
+    Builds the SectionIndex over every (filename, doc_path) job. Documents
+    are indexed in input order, so the index is the same no matter which
+    document finishes first or whether it came from the store.
+    """
+    return index_documents(iter_analyzed_documents(doc_jobs, workers, store), store, keep_text, metrics)
+
+def document_boost(doc_name_lower):
+    """
+    Prior for documents whose name is strongly related to HR/forms work.
+    """
+    if "fill and sign" in doc_name_lower or "request e-signatures" in doc_name_lower:
+        return 40 # Highest boost for direct form/signature relevance
+    elif "create and convert" in doc_name_lower or "edit" in doc_name_lower:
+        return 30 # High boost for creation/editing tools
+    elif "generative ai" in doc_name_lower:
+        return 20 # Moderate boost for AI tools
+    elif "share" in doc_name_lower or "export" in doc_name_lower:
+        return 15 # Boost for related workflows
+    elif "test your acrobat" in doc_name_lower or "pdf sharing checklist" in doc_name_lower:
+        return 10 # Boost for general Acrobat/PDF tips
+    return 0
 
-def rank_and_filter_sections(sections, job_to_be_done_task, persona_role):
+def title_boost(section_title_lower):
     """
-    Ranks sections based on relevance to the job_to_be_done and persona.
+    Additional boosts for section titles indicating key topics.
+    """
+    boost = 0
+    if "form" in section_title_lower or "signature" in section_title_lower or "onboarding" in section_title_lower:
+        boost += 15
+    if "compliance" in section_title_lower or "security" in section_title_lower or "privacy" in section_title_lower:
+        boost += 10
+    return boost
+
+def rank_and_filter_sections(sections, job_to_be_done_task, persona_role, top_k=10, index=None):
+    """
+    Ranks sections based on relevance to the job_to_be_done and persona:
+    BM25F over the inverted index plus the document and title boosts.
     Optimized for HR professional and form management documents.
+    Pass a prebuilt SectionIndex over the same sections to skip indexing.
+    Only the best top_k sections are kept while scoring (a bounded heap, same
+    order and tie-breaking as a full stable sort), so memory does not grow
+    with the number of sections.
+    Returns (top_k extracted sections, [(section_id, score)] best first for
+    the subsection analysis).
     """
-    ranked_sections = []
-    
-    job_keywords = job_to_be_done_task.lower().split()
-    persona_keywords = persona_role.lower().split()
-    
-    # General relevant terms for HR and form management
-    general_keywords = ["form", "forms", "fillable", "onboarding", "compliance", "signature", 
-                        "e-signature", "sign", "request", "create", "manage", "edit", 
-                        "convert", "export", "share", "pdf", "document", "digital", 
-                        "workflow", "template", "review", "privacy", "security", "ai",
-                        "human resources", "hr"]
-
-    all_keywords = list(set(job_keywords + persona_keywords + general_keywords))
-
-    for section in sections:
-        score = 0
-        section_text_lower = section.get("text_content", "").lower()
-        section_title_lower = section.get("section_title", "").lower()
-
-        # Score based on keyword presence
-        for keyword in all_keywords:
-            if keyword in section_title_lower:
-                score += 10 # Higher score for title matches
-            if keyword in section_text_lower:
-                score += 2 # Score for text matches
-
-        doc_name_lower = section["document"].lower()
-
-        # Dynamic boosting based on document content/title strongly related to HR/forms
-        if "fill and sign" in doc_name_lower or "request e-signatures" in doc_name_lower:
-            score += 40 # Highest boost for direct form/signature relevance
-        elif "create and convert" in doc_name_lower or "edit" in doc_name_lower:
-            score += 30 # High boost for creation/editing tools
-        elif "generative ai" in doc_name_lower:
-            score += 20 # Moderate boost for AI tools
-        elif "share" in doc_name_lower or "export" in doc_name_lower:
-            score += 15 # Boost for related workflows
-        elif "test your acrobat" in doc_name_lower or "pdf sharing checklist" in doc_name_lower:
-            score += 10 # Boost for general Acrobat/PDF tips
-
-        # Additional boosts for section titles indicating key topics
-        if "form" in section_title_lower or "signature" in section_title_lower or "onboarding" in section_title_lower:
-            score += 15
-        if "compliance" in section_title_lower or "security" in section_title_lower or "privacy" in section_title_lower:
-            score += 10
-
-
-        section["relevance_score"] = score
-        ranked_sections.append(section)
-
-    ranked_sections.sort(key=lambda x: x["relevance_score"], reverse=True)
-    
+    if index is None:
+        index = SectionIndex(sections)
+    bm25_scores = index.bm25_scores(build_query_terms(job_to_be_done_task, persona_role))
+
+    def scored_sections():
+        document_boosts = {} # Computed once per document, not once per section
+        for section_id, section in enumerate(index.sections):
+            document_name = section["document"]
+            if document_name not in document_boosts:
+                document_boosts[document_name] = document_boost(document_name.lower())
+            yield section_id, bm25_scores.get(section_id, 0.0) + document_boosts[document_name] + title_boost(index.titles_lower[section_id])
+
+    top_ranked = heapq.nlargest(top_k, scored_sections(), key=lambda item: item[1])
+
     final_extracted_sections = []
-    # Take top 10 relevant sections, only if score is positive
-    for i, sec in enumerate(ranked_sections):
-        if sec["relevance_score"] > 0 and i < 10:
+    # Take top_k relevant sections, only if score is positive
+    for i, (section_id, score) in enumerate(top_ranked):
+        if score > 0:
+            sec = index.sections[section_id]
             final_extracted_sections.append({
                 "document": sec["document"],
                 "section_title": sec["section_title"],
                 "importance_rank": i + 1,
                 "page_number": sec["page_number"]
             })
-    
-    return final_extracted_sections, ranked_sections # Return both for potential subsection analysis
 
-def refine_subsection_text(section_text, job_to_be_done_task):
+    return final_extracted_sections, top_ranked # Return both for the subsection analysis
+
+# --- Subsection analysis: extractive sentence selection, scored in one batch ---
+REFINED_TEXT_BUDGET = 500 # Characters of refined_text per section
+# HR/forms terms that make a sentence relevant on top of the job's own words
+REFINE_KEYWORDS = ["form", "fillable", "signature", "e-signature", "onboarding", "compliance",
+                   "create", "manage", "edit", "pdf", "document"]
+REFINE_KEYWORD_WEIGHT = 0.5 # A domain keyword counts half as much as a word from the job itself
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?])\s+')
+
+def clean_section_text(section_text):
     """
-    Refines section text based on the job_to_be_done, making it cleaner and
-    more readable by removing extraneous newlines and ensuring proper stripping.
+    Makes section text cleaner and more readable: ligatures expanded, bullets
+    and non-ASCII characters removed, newlines collapsed, stripped.
     """
     # 1. Handle ligatures (like \ufb00 for 'ff')
     cleaned_text = section_text.replace('\ufb00', 'ff')
@@ -159,52 +731,255 @@ def refine_subsection_text(section_text, job_to_be_done_task):
 
     # Aggressively replace multiple newlines with a single space and strip overall
     # This helps in creating cleaner "sentences" before splitting
-    cleaned_text = re.sub(r'\s*\n\s*', ' ', cleaned_text).strip()
-    
-    sentences = re.split(r'(?<=[.!?])\s+', cleaned_text)
-    relevant_sentences = []
-    task_keywords = job_to_be_done_task.lower().split()
-
-    # Enhanced keyword check for sentence relevance related to HR/Forms
-    extended_task_keywords = list(set(task_keywords + ["form", "fillable", "signature", "e-signature", "onboarding", "compliance", "create", "manage", "edit", "pdf", "document"]))
-
-
-    for sentence in sentences:
-        stripped_sentence = sentence.strip() # Ensure each individual sentence is stripped
-        if any(keyword in stripped_sentence.lower() for keyword in extended_task_keywords):
-            relevant_sentences.append(stripped_sentence)
-    
-    if relevant_sentences:
-        refined_text = " ".join(relevant_sentences)
-        refined_text = refined_text.strip() # Final strip to catch any leading/trailing spaces
-        if len(refined_text) > 500: # Truncate if too long
-            refined_text = refined_text[:497] + "..."
-        return refined_text
-    else:
-        # Fallback if no relevant sentences found, ensure it's also stripped
-        if len(cleaned_text) > 500:
-            return cleaned_text[:497] + "..."
-        return cleaned_text.strip()
+    return re.sub(r'\s*\n\s*', ' ', cleaned_text).strip()
 
+def build_refine_weights(job_to_be_done_task):
+    """
+    Returns {term: weight} for sentence scoring: the job's terms at 1.0 and the
+    domain keywords at REFINE_KEYWORD_WEIGHT.
+    """
+    weights = dict.fromkeys(tokenize(" ".join(REFINE_KEYWORDS)), REFINE_KEYWORD_WEIGHT)
+    weights.update(dict.fromkeys(tokenize(job_to_be_done_task), 1.0))
+    return weights
 
-def run_document_analysis():
-    print(f"[{os.getenv('HOSTNAME')}] Starting document analysis...")
+def score_sentences(sentences, term_weights):
+    """
+    Scores every sentence against the weighted query terms at once and
+    returns a float array, one score per sentence.
 
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    All sentences are tokenized in a single regex pass over their
+    concatenation, each token is mapped to its sentence with searchsorted,
+    and the query-term hits form a sparse sentence x term count matrix (COO
+    rows/columns/counts). The score is BM25 over that matrix, idf taken
+    across the batch, computed as one sparse matrix-vector product.
+    """
+    sentence_count = len(sentences)
+    if not sentence_count:
+        return np.zeros(0)
+    joined = "\n".join(sentences).lower()
+    sentence_starts = np.cumsum([0] + [len(sentence) + 1 for sentence in sentences[:-1]])
 
-    # Get the collection name from an environment variable
-    collection_name = os.getenv('COLLECTION_TO_PROCESS')
-    if not collection_name:
-        print(f"[{os.getenv('HOSTNAME')}] ERROR: Please specify the collection to process using the 'COLLECTION_TO_PROCESS' environment variable.")
-        print(f"[{os.getenv('HOSTNAME')}] Example: docker run -e COLLECTION_TO_PROCESS=collection1 ...")
-        return
+    term_ids = {term: term_id for term_id, term in enumerate(term_weights)}
+    token_starts, token_terms = [], []
+    for match in TOKEN_PATTERN.finditer(joined):
+        token = match.group()
+        if token in STOPWORDS:
+            continue
+        parts = [token] + ([part for part in token.split("-") if part and part not in STOPWORDS] if "-" in token else [])
+        for part in parts:
+            token_starts.append(match.start())
+            token_terms.append(term_ids.get(part, -1))
+    if not token_starts:
+        return np.zeros(sentence_count)
+
+    token_rows = np.searchsorted(sentence_starts, np.asarray(token_starts), side="right") - 1
+    token_terms = np.asarray(token_terms)
+    lengths = np.bincount(token_rows, minlength=sentence_count).astype(float)
+
+    hits = token_terms >= 0
+    vocabulary_size = len(term_ids)
+    cells, counts = np.unique(token_rows[hits] * vocabulary_size + token_terms[hits], return_counts=True)
+    rows, columns = np.divmod(cells, vocabulary_size)
+    if not len(rows):
+        return np.zeros(sentence_count)
+
+    document_frequency = np.bincount(columns, minlength=vocabulary_size)
+    idf = np.log(1 + (sentence_count - document_frequency + 0.5) / (document_frequency + 0.5))
+    column_weights = np.fromiter(term_weights.values(), dtype=float, count=vocabulary_size) * idf
+
+    average_length = lengths.mean() or 1.0
+    saturated = counts * (BM25_K1 + 1) / (counts + BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / average_length))
+    return np.bincount(rows, weights=saturated * column_weights[columns], minlength=sentence_count)
+
+def truncate_text(text, budget=REFINED_TEXT_BUDGET):
+    return text if len(text) <= budget else text[:budget - 3] + "..."
+
+def refine_subsections(section_texts, job_to_be_done_task, budget=REFINED_TEXT_BUDGET):
+    """
+    Refines several sections' texts for the job_to_be_done in one batch.
+    Every sentence of every section is scored together (score_sentences); each
+    section then keeps its best-scoring sentences, best first, for as long as
+    they fit within budget characters, and returns them in reading order.
+    A section with no relevant sentence falls back to its cleaned text, and a
+    single best sentence longer than the budget is truncated.
+    """
+    cleaned_texts = [clean_section_text(text) for text in section_texts]
+    sentences, owners = [], []
+    for owner, cleaned_text in enumerate(cleaned_texts):
+        for sentence in SENTENCE_SPLIT_PATTERN.split(cleaned_text):
+            sentence = sentence.strip() # Ensure each individual sentence is stripped
+            if sentence:
+                sentences.append(sentence)
+                owners.append(owner)
+    scores = score_sentences(sentences, build_refine_weights(job_to_be_done_task))
+
+    owners = np.asarray(owners, dtype=int)
+    positions = np.arange(len(sentences))
+    # Best sentence first within each section, ties in reading order
+    order = np.lexsort((positions, -scores, owners))
+    cost = np.fromiter((len(sentences[i]) + 1 for i in order), dtype=int, count=len(order)) # +1 for the joining space
+    cumulative = np.cumsum(cost)
+    group_starts = np.searchsorted(owners[order], owners[order], side="left")
+    used = cumulative - np.concatenate(([0], cumulative))[group_starts]
+    selected = order[(scores[order] > 0) & (used <= budget + 1)]
+
+    chosen = [[] for _ in cleaned_texts]
+    for i in np.sort(selected):
+        chosen[owners[i]].append(sentences[i])
+
+    refined_texts = []
+    for owner, cleaned_text in enumerate(cleaned_texts):
+        if chosen[owner]:
+            refined_texts.append(" ".join(chosen[owner]))
+            continue
+        # Nothing fits: the best sentence alone is over budget, or no sentence is relevant
+        section_rows = order[owners[order] == owner]
+        if len(section_rows) and scores[section_rows[0]] > 0:
+            refined_texts.append(truncate_text(sentences[section_rows[0]], budget))
+        else:
+            refined_texts.append(truncate_text(cleaned_text, budget))
+    return refined_texts
+
+def refine_subsection_text(section_text, job_to_be_done_task):
+    """
+    Refines one section's text for the job_to_be_done; see refine_subsections.
+    """
+    return refine_subsections([section_text], job_to_be_done_task)[0]
+
+
+# --- Queries: one persona/job pair per output file ---
+EXTRACTED_SECTION_COUNT = 10 # Sections listed in extracted_sections
+SUBSECTION_COUNT = 5 # Top sections refined for subsection_analysis
+
+def analyze_query(section_index, persona_role, job_task, input_documents, metrics=None):
+    """
+    Ranks the indexed sections for one persona/job query and returns the
+    output JSON data: metadata, extracted_sections and subsection_analysis.
+    Pass a StageMetrics to time the rank and refine stages and count the
+    query terms found in the index (keywords_matched).
+    """
+    with _stage(metrics, "rank"):
+        final_extracted_sections_output, top_ranked = rank_and_filter_sections(
+            section_index.sections, job_task, persona_role, top_k=max(EXTRACTED_SECTION_COUNT, SUBSECTION_COUNT), index=section_index)
+    final_extracted_sections_output = final_extracted_sections_output[:EXTRACTED_SECTION_COUNT]
+
+    # Refine only the top sections with a positive score, fetching their text (if it was dropped) only now
+    refined_ids = list(itertools.takewhile(lambda item: item[1] > 0, top_ranked[:SUBSECTION_COUNT]))
+    with _stage(metrics, "refine"):
+        refined_texts = refine_subsections(section_index.section_texts([section_id for section_id, _ in refined_ids]), job_task)
+    if metrics:
+        query_terms = build_query_terms(job_task, persona_role)
+        metrics.count("query_terms", len(query_terms))
+        metrics.count("keywords_matched", sum(1 for term in query_terms
+                                              if term in section_index.title_postings or term in section_index.body_postings))
+        metrics.count("extracted_sections", len(final_extracted_sections_output))
+        metrics.count("refined_sections", len(refined_ids))
+    subsection_analysis_output = []
+    for (section_id, _), refined_text in zip(refined_ids, refined_texts):
+        section = section_index.sections[section_id]
+        subsection_analysis_output.append({
+            "document": section["document"],
+            "refined_text": refined_text,
+            "page_number": section["page_number"]
+        })
+
+    return {
+        "metadata": {
+            "input_documents": input_documents,
+            "persona": persona_role,
+            "job_to_be_done": job_task,
+            "processing_timestamp": datetime.utcnow().isoformat()
+        },
+        "extracted_sections": final_extracted_sections_output,
+        "subsection_analysis": subsection_analysis_output
+    }
+
+def load_queries(input_data):
+    """
+    Returns the batch queries as [(name, persona_role, job_task)], or [] for a
+    normal single-query run. Queries come from the file named by
+    ANALYSIS_QUERIES if set, otherwise from a "queries" list in input.json.
+    Each query has the same "persona" and "job_to_be_done" objects as
+    input.json plus an optional "name" for its output file.
+    """
+    queries = input_data.get("queries") or []
+    if ANALYSIS_QUERIES:
+        with open(ANALYSIS_QUERIES, 'r', encoding='utf-8') as f:
+            queries = json.load(f)
+        if isinstance(queries, dict):
+            queries = queries.get("queries", [])
+    if not isinstance(queries, list):
+        raise ValueError("queries must be a list")
+
+    parsed = []
+    for number, query in enumerate(queries, start=1):
+        if not isinstance(query, dict):
+            raise ValueError(f"query {number} must be an object")
+        if not all(isinstance(query.get(field, {}), dict) for field in ("persona", "job_to_be_done")):
+            raise ValueError(f"query {number}: \"persona\" and \"job_to_be_done\" must be objects")
+        persona_role = query.get("persona", {}).get("role", "N/A")
+        job_task = query.get("job_to_be_done", {}).get("task", "N/A")
+        if not isinstance(persona_role, str) or not isinstance(job_task, str):
+            raise ValueError(f"query {number}: \"role\" and \"task\" must be strings")
+        name = re.sub(r"[^\w.-]+", "_", str(query.get("name") or f"query{number}")).strip("_") or f"query{number}"
+        if name in {existing for existing, _, _ in parsed}:
+            name = f"{name}_{number}" # Keep every query's output file distinct
+        parsed.append((name, persona_role, job_task))
+    return parsed
+
+_worker_section_index = None # Set in each query worker by _init_query_worker
+
+def _init_query_worker(section_index):
+    global _worker_section_index
+    _worker_section_index = section_index
+
+def _analyze_query_in_worker(persona_role, job_task, input_documents, query_metrics):
+    output_data = analyze_query(_worker_section_index, persona_role, job_task, input_documents, query_metrics)
+    return output_data, query_metrics
+
+def analyze_queries(section_index, queries, input_documents, workers=ANALYSIS_WORKERS, metrics=None):
+    """
+    Runs analyze_query for every (name, persona_role, job_task) query against
+    the same section index, on a process pool when workers > 1. Each worker
+    receives the index once, not once per query. Returns the output data in
+    query order; each query's StageMetrics is added to metrics (a
+    CollectionMetrics) when given.
+    """
+    query_metrics = [StageMetrics(name) if metrics is not None else None for name, _, _ in queries]
+    if workers > 1 and len(queries) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(queries)),
+                                 initializer=_init_query_worker, initargs=(section_index,)) as executor:
+            futures = [executor.submit(_analyze_query_in_worker, persona_role, job_task, input_documents, query_metric)
+                       for (_, persona_role, job_task), query_metric in zip(queries, query_metrics)]
+            results = [future.result() for future in futures]
+    else:
+        results = [(analyze_query(section_index, persona_role, job_task, input_documents, query_metric), query_metric)
+                   for (_, persona_role, job_task), query_metric in zip(queries, query_metrics)]
+    if metrics is not None:
+        for _, query_metric in results:
+            metrics.add_query(query_metric)
+    return [output_data for output_data, _ in results]
+
+def write_output(output_data, output_json_path):
+    try:
+        with open(output_json_path, 'w', encoding='utf-8') as f:
+            json.dump(output_data, f, indent=4)
+        print(f"[{os.getenv('HOSTNAME')}] Successfully wrote output to {output_json_path}")
+    except Exception as e:
+        print(f"[{os.getenv('HOSTNAME')}] ERROR writing output: {e}")
 
+def load_collection(collection_name):
+    """
+    Reads a collection's input.json and returns what is needed to analyze it,
+    as a dict (name, persona_role, job_task, documents_info, queries,
+    doc_jobs, store), or None after printing the reason it cannot be processed.
+    """
     # input.json path is now inside the collection folder
     input_json_path = os.path.join(INPUT_ROOT_DIR, collection_name, INPUT_JSON_FILENAME)
-    
+
     if not os.path.exists(input_json_path):
         print(f"[{os.getenv('HOSTNAME')}] ERROR: {INPUT_JSON_FILENAME} not found at {input_json_path}. Please ensure it's in your collection folder.")
-        return
+        return None
 
     try:
         with open(input_json_path, 'r', encoding='utf-8') as f:
@@ -212,23 +987,22 @@ def run_document_analysis():
         print(f"[{os.getenv('HOSTNAME')}] Successfully loaded {INPUT_JSON_FILENAME} from {collection_name} folder.")
     except json.JSONDecodeError as e:
         print(f"[{os.getenv('HOSTNAME')}] ERROR: Could not parse {INPUT_JSON_FILENAME} in {collection_name} folder: {e}")
-        return
+        return None
 
     persona_role = input_data.get("persona", {}).get("role", "N/A")
     job_task = input_data.get("job_to_be_done", {}).get("task", "N/A")
     documents_info = input_data.get("documents", [])
-    
-    # Set output filename based on collection name
-    output_json_filename = f"{collection_name}_output.json"
+    try:
+        queries = load_queries(input_data)
+    except (OSError, ValueError) as e:
+        print(f"[{os.getenv('HOSTNAME')}] ERROR: Could not load batch queries: {e}")
+        return None
 
     print(f"[{os.getenv('HOSTNAME')}] Persona Role: {persona_role}")
     print(f"[{os.getenv('HOSTNAME')}] Job to be done Task: {job_task}")
     print(f"[{os.getenv('HOSTNAME')}] Processing collection: {collection_name}")
-    print(f"[{os.getenv('HOSTNAME')}] Output filename: {output_json_filename}")
 
-    print(f"[{os.getenv('HOSTNAME')}] --- Extracting Text and Identifying Sections ---")
-    all_raw_sections = [] # To store all sections with their raw text
-    
+    doc_jobs = [] # (filename, doc_path) for every document that exists
     for doc_info in documents_info:
         filename = doc_info.get("filename")
         if not filename:
@@ -241,66 +1015,162 @@ def run_document_analysis():
             print(f"[{os.getenv('HOSTNAME')}] WARNING: Document '{filename}' not found at '{doc_path}'. Skipping.")
             continue
 
-        try:
-            doc_full_text = []
-            doc = fitz.open(doc_path)
-            print(f"[{os.getenv('HOSTNAME')}] Reading PDF: {filename} (Pages: {doc.page_count})")
-            for page_num in range(doc.page_count):
-                page = doc.load_page(page_num)
-                text = page.get_text("text")
-                doc_full_text.append(f"--- Page {page_num + 1} ---\n{text}") # Add page marker
-            doc.close()
-            
-            # Extract sections from the full text of the document
-            sections_from_doc = extract_sections_from_text("\n".join(doc_full_text), filename)
-            all_raw_sections.extend(sections_from_doc)
-
-        except Exception as e:
-            print(f"[{os.getenv('HOSTNAME')}] ERROR processing {filename}: {e}")
+        doc_jobs.append((filename, doc_path))
 
-    print(f"[{os.getenv('HOSTNAME')}] --- Section Identification Complete. Ranking Sections ---")
-    
-    # Pass persona_role to the ranking function
-    final_extracted_sections_output, ranked_sections_with_text = rank_and_filter_sections(all_raw_sections, job_task, persona_role)
+    return {
+        "name": collection_name,
+        "persona_role": persona_role,
+        "job_task": job_task,
+        "documents_info": documents_info,
+        "queries": queries,
+        "doc_jobs": doc_jobs,
+        "store": SectionIndexStore(SECTION_INDEX_DIR, collection_name) if SECTION_INDEX_DIR else None,
+        "metrics": CollectionMetrics(collection_name) if ANALYSIS_METRICS or ANALYSIS_TRACE else None
+    }
 
-    print(f"[{os.getenv('HOSTNAME')}] --- Generating Subsection Analysis ---")
-    subsection_analysis_output = []
-    # Take the top 5 most important sections from ranked_sections_with_text for detailed analysis
-    for i, section in enumerate(ranked_sections_with_text):
-        if i < 5 and section["relevance_score"] > 0: # Ensure positive score for subsection analysis
-            refined_text = refine_subsection_text(section["text_content"], job_task)
-            subsection_analysis_output.append({
-                "document": section["document"],
-                "refined_text": refined_text,
-                "page_number": section["page_number"]
-            })
-        elif section["relevance_score"] <= 0: # Stop if relevance drops to zero or negative
-            break
-        else:
-            break # Stop after top 5 for efficiency in this example
+def write_collection_outputs(collection, section_index):
+    """
+    Ranks the collection's query (or batch of queries) against its section
+    index and writes <collection>_output.json (or one
+    <collection>_<query>_output.json per batch query), then the collection's
+    <collection>_metrics.json and <collection>_trace.json when enabled.
+    """
+    collection_name = collection["name"]
+    input_documents = [d.get("filename") for d in collection["documents_info"]]
+    metrics = collection["metrics"]
 
-    print(f"[{os.getenv('HOSTNAME')}] --- Creating Output JSON ---")
-    output_data = {
-        "metadata": {
-            "input_documents": [d.get("filename") for d in documents_info],
-            "persona": persona_role,
-            "job_to_be_done": job_task,
-            "processing_timestamp": datetime.utcnow().isoformat()
-        },
-        "extracted_sections": final_extracted_sections_output,
-        "subsection_analysis": subsection_analysis_output
-    }
+    if collection["queries"]:
+        # Batch mode: every query is ranked against the one shared section index
+        print(f"[{os.getenv('HOSTNAME')}] Batch mode: {len(collection['queries'])} persona/job queries for {collection_name}")
+        outputs = analyze_queries(section_index, collection["queries"], input_documents, metrics=metrics)
+        with _stage(metrics, "write"):
+            for (query_name, _, _), output_data in zip(collection["queries"], outputs):
+                write_output(output_data, os.path.join(OUTPUT_DIR, f"{collection_name}_{query_name}_output.json"))
+    else:
+        query_metrics = StageMetrics(collection_name) if metrics is not None else None
+        output_data = analyze_query(section_index, collection["persona_role"], collection["job_task"], input_documents, query_metrics)
+        if metrics is not None:
+            metrics.add_query(query_metrics)
+        print(f"[{os.getenv('HOSTNAME')}] --- Creating Output JSON ---")
+        with _stage(metrics, "write"):
+            write_output(output_data, os.path.join(OUTPUT_DIR, f"{collection_name}_output.json"))
+
+    if metrics is not None:
+        metrics.write(os.path.join(OUTPUT_DIR, f"{collection_name}_metrics.json") if ANALYSIS_METRICS else None,
+                      os.path.join(OUTPUT_DIR, f"{collection_name}_trace.json") if ANALYSIS_TRACE else None)
+
+def discover_collections(input_root_dir=None):
+    """
+    Returns the names of the folders under input_root_dir (default
+    INPUT_ROOT_DIR) that contain an input.json, sorted.
+    """
+    input_root_dir = input_root_dir or INPUT_ROOT_DIR
+    return sorted(name for name in os.listdir(input_root_dir)
+                  if os.path.isfile(os.path.join(input_root_dir, name, INPUT_JSON_FILENAME)))
+
+def run_all_collections(workers=ANALYSIS_WORKERS):
+    """
+    Analyzes every collection under INPUT_ROOT_DIR in one run. The documents
+    of all collections are submitted, collection by collection, to one shared
+    process pool, so workers move straight on to the next collection's PDFs
+    instead of idling while the previous one is ranked. Each collection is
+    indexed, ranked and written as soon as its last document is done, and a
+    summary with per-collection timings is printed at the end.
+    """
+    run_start = time.perf_counter()
+    collections = [collection for collection in map(load_collection, discover_collections()) if collection]
+    print(f"[{os.getenv('HOSTNAME')}] Processing {len(collections)} collections: {', '.join(c['name'] for c in collections)}")
+    summary = []
+
+    def finish(collection, futures):
+        # All of this collection's pool work is done: index in input order, rank, write
+        finish_start = time.perf_counter()
+        content_hashes = collection["content_hashes"]
+        store = collection["store"]
+        analyzed_documents = (
+            (filename, doc_path, content_hashes[position])
+            + resolve_entry(filename, doc_path, content_hashes[position], store, futures.get(position))
+            for position, (filename, doc_path) in enumerate(collection["doc_jobs"])
+        )
+        section_index = index_documents(analyzed_documents, store, metrics=collection["metrics"])
+        write_collection_outputs(collection, section_index)
+        summary.append({
+            "collection": collection["name"],
+            "documents": len(collection["doc_jobs"]),
+            "sections": len(section_index.sections),
+            "finish_seconds": time.perf_counter() - finish_start,
+            "finished_after_seconds": time.perf_counter() - run_start
+        })
+        print(f"[{os.getenv('HOSTNAME')}] Finished collection {collection['name']}")
 
-    output_json_path = os.path.join(OUTPUT_DIR, output_json_filename)
+    remaining = {} # collection index -> documents still running on the pool
+    futures_by_collection = [{} for _ in collections]
+    owner_of = {} # future -> (collection index, document position)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
     try:
-        with open(output_json_path, 'w', encoding='utf-8') as f:
-            json.dump(output_data, f, indent=4)
-        print(f"[{os.getenv('HOSTNAME')}] Successfully wrote output to {output_json_path}")
-    except Exception as e:
-        print(f"[{os.getenv('HOSTNAME')}] ERROR writing output: {e}")
+        for collection_index, collection in enumerate(collections):
+            collection["content_hashes"], pending = plan_documents(collection["doc_jobs"], collection["store"])
+            if executor is None or not pending:
+                continue
+            for position in pending:
+                filename, doc_path = collection["doc_jobs"][position]
+                future = executor.submit(analyze_document, doc_path, filename)
+                futures_by_collection[collection_index][position] = future
+                owner_of[future] = collection_index
+            remaining[collection_index] = len(pending)
+
+        # Collections with nothing on the pool (serial run, or fully served by the store)
+        for collection_index, collection in enumerate(collections):
+            if collection_index not in remaining:
+                finish(collection, futures_by_collection[collection_index])
+
+        for future in as_completed(owner_of):
+            collection_index = owner_of[future]
+            remaining[collection_index] -= 1
+            if not remaining[collection_index]:
+                finish(collections[collection_index], futures_by_collection[collection_index])
+                futures_by_collection[collection_index] = None # Release its results
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    print(f"[{os.getenv('HOSTNAME')}] --- Run Summary ({time.perf_counter() - run_start:.2f}s) ---")
+    for row in summary:
+        print(f"[{os.getenv('HOSTNAME')}] {row['collection']}: {row['documents']} documents, {row['sections']} sections, "
+              f"indexed, ranked and written in {row['finish_seconds']:.2f}s, finished after {row['finished_after_seconds']:.2f}s")
+    return summary
+
+def run_document_analysis():
+    print(f"[{os.getenv('HOSTNAME')}] Starting document analysis...")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # Get the collection name from an environment variable
+    collection_name = os.getenv('COLLECTION_TO_PROCESS')
+    if not collection_name:
+        print(f"[{os.getenv('HOSTNAME')}] ERROR: Please specify the collection to process using the 'COLLECTION_TO_PROCESS' environment variable.")
+        print(f"[{os.getenv('HOSTNAME')}] Example: docker run -e COLLECTION_TO_PROCESS=collection1 ... (or COLLECTION_TO_PROCESS={ALL_COLLECTIONS} for every collection)")
+        return
+
+    if collection_name == ALL_COLLECTIONS:
+        run_all_collections()
+        print(f"[{os.getenv('HOSTNAME')}] Document analysis finished.")
+        return
+
+    collection = load_collection(collection_name)
+    if collection is None:
+        return
+    print(f"[{os.getenv('HOSTNAME')}] Output filename: {collection_name}_output.json")
+
+    print(f"[{os.getenv('HOSTNAME')}] --- Extracting Text and Identifying Sections ---")
+    # All sections with their raw text, in input.json document order, indexed for ranking
+    section_index = build_section_index(collection["doc_jobs"], store=collection["store"], metrics=collection["metrics"])
+
+    print(f"[{os.getenv('HOSTNAME')}] --- Section Identification Complete. Ranking Sections ---")
+    write_collection_outputs(collection, section_index)
 
     print(f"[{os.getenv('HOSTNAME')}] Document analysis finished.")
 
 
 if __name__ == "__main__":
-    run_document_analysis()
\ No newline at end of file
+    run_document_analysis()
@@ -0,0 +1,673 @@
+"""
+Shared PDF layout analysis for Round 1A and Round 1B.
+
+A PDF is parsed once, with a single get_text("dict") pass, into a LayoutModel:
+its page count and one LineRecord per text line. Everything else is derived
+from those records: the title and font size thresholds, the H1/H2/H3
+headings, the Round 1A outline and the Round 1B heading-bounded sections.
+With LAYOUT_CACHE_DIR set, models are saved keyed by the PDF's content hash,
+so when both pipelines run over the same corpus each document is parsed by
+whichever runs first and simply loaded by the other. In low-memory mode
+without a cache, Round 1B sections a document page by page instead
+(stream_sections), so it never holds the whole model.
+"""
+import gc
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import resource
+import sys
+
+import fitz # PyMuPDF
+import numpy as np
+
+# Directory shared by both pipelines for parsed layout models; unset disables it
+LAYOUT_CACHE_DIR = os.getenv("LAYOUT_CACHE_DIR")
+# Size limit of that directory's layout models; least recently used ones are evicted past it
+LAYOUT_CACHE_MAX_MB = float(os.getenv("LAYOUT_CACHE_MAX_MB", "1024"))
+# Bump whenever LineRecord or the layout pass changes so cached models are invalidated
+LAYOUT_VERSION = "2"
+# Low-memory I/O: memory-mapped input and MuPDF caches emptied after every page
+LAYOUT_LOW_MEMORY = os.getenv("LAYOUT_LOW_MEMORY", "0").lower() in ("1", "true", "yes")
+# Per-process resident memory limit in MB while reading pages; 0 = no limit
+LAYOUT_RSS_BUDGET_MB = float(os.getenv("LAYOUT_RSS_BUDGET_MB", "0"))
+
+# Text flags for the layout pass: the defaults used by get_text("dict"), minus
+# image blocks, which none of the heuristics below ever look at.
+LAYOUT_TEXT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+class LineRecord:
+    """
+    One text line from the layout pass, reduced to the fields the heuristics use.
+    Font properties come from the first span, as representative for the line;
+    all_bold tells whether every span with text is bold. block is the index of
+    the line's text block on its page.
+    """
+    __slots__ = ("text", "size", "font", "flags", "bbox", "page", "block", "all_bold")
+
+    def __init__(self, text, size, font, flags, bbox, page, block, all_bold):
+        self.text = text
+        self.size = size
+        self.font = font
+        self.flags = flags
+        self.bbox = bbox
+        self.page = page
+        self.block = block
+        self.all_bold = all_bold
+
+# --- Memory: mapped input, page-wise release and the RSS budget ---
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB; the peak so far where the
+    current value is not available (no /proc).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class MemoryMonitor:
+    """
+    Samples RSS after every page to record a document's peak memory and to
+    enforce the budget. Over budget it first empties MuPDF's resource store
+    and collects garbage; if that is not enough the document fails with
+    MemoryBudgetExceeded instead of the process being killed.
+    """
+
+    def __init__(self, budget_mb=None, low_memory=None):
+        self.budget_mb = LAYOUT_RSS_BUDGET_MB if budget_mb is None else budget_mb
+        self.low_memory = LAYOUT_LOW_MEMORY if low_memory is None else low_memory
+        self.peak_mb = current_rss_mb()
+
+    def after_page(self):
+        if self.low_memory:
+            fitz.TOOLS.store_shrink(100)
+        rss_mb = current_rss_mb()
+        if self.budget_mb and rss_mb > self.budget_mb:
+            fitz.TOOLS.store_shrink(100)
+            gc.collect()
+            rss_mb = current_rss_mb()
+            if rss_mb > self.budget_mb:
+                self.peak_mb = max(self.peak_mb, rss_mb)
+                raise MemoryBudgetExceeded(f"RSS {rss_mb:.0f} MB exceeds the {self.budget_mb:.0f} MB budget")
+        self.peak_mb = max(self.peak_mb, rss_mb)
+
+def open_document(source, low_memory=None):
+    """
+    Opens a PDF from a file path or from the raw bytes of the file. In
+    low-memory mode a path is memory-mapped and opened as a stream, so the
+    file's bytes stay in the page cache instead of being copied onto the heap;
+    the mapping lives as long as the returned document.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    if LAYOUT_LOW_MEMORY if low_memory is None else low_memory:
+        with open(source, "rb") as f:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError: # Empty file: let fitz report it
+                return fitz.open(source)
+        return fitz.open(stream=memoryview(mapping), filetype="pdf")
+    return fitz.open(source)
+
+def extract_line_records(document, start_page=0, end_page=None, monitor=None):
+    """
+    Walks every page of the document exactly once and returns a flat list of
+    LineRecord objects. Page numbers are 0-based, like document indices.
+    start_page/end_page restrict the pass to a page range (used for shards).
+    Each page and its text dict are released before the next page is read,
+    and the monitor (a MemoryMonitor; one using the configured budget if not
+    given) is consulted after every page.
+    """
+    if end_page is None:
+        end_page = document.page_count
+    if monitor is None:
+        monitor = MemoryMonitor()
+    records = []
+    for page_num in range(start_page, end_page):
+        page = document[page_num]
+        blocks = page.get_text("dict", flags=LAYOUT_TEXT_FLAGS)["blocks"]
+        del page
+        for block_num, b in enumerate(blocks):
+            if b["type"] != 0: # Only process text blocks
+                continue
+            for line in b["lines"]:
+                spans = line["spans"]
+                if not spans: # Skip if no spans (empty line)
+                    continue
+                first_span = spans[0]
+                # Join spans to reassemble potentially fragmented text, and strip.
+                # Whitespace-only lines are kept: they still count towards the font size histogram.
+                records.append(LineRecord(
+                    "".join([span["text"] for span in spans]).strip(),
+                    first_span["size"],
+                    first_span["font"],
+                    first_span["flags"],
+                    tuple(line["bbox"]),
+                    page_num,
+                    block_num,
+                    all(is_bold_span(span) for span in spans if span["text"].strip())
+                ))
+        del blocks
+        monitor.after_page()
+    return records
+
+# --- Heading rules: every pattern is compiled once at import, not per line ---
+# Bump whenever the title/heading heuristics change so cached outlines are invalidated
+HEURISTICS_VERSION = "1"
+
+# Title candidates that are just numbers/patterns like "1."
+TITLE_NUMBER_PATTERN = re.compile(r'^\d+(\.\d+){0,2}\s*$')
+# Known header/footer strings that must not become the title
+TITLE_REJECT_PATTERN = re.compile(r'^(RFP:\s*(Request)?\s*for\s*Proposal|March\s*\d{1,2},\s*\d{4})$', re.IGNORECASE)
+# Heuristic 1: very short symbols, numbers, or common footer/header text
+SHORT_NUMBERED_PATTERN = re.compile(r'^\d+(\.\d+){0,2}\s')
+SYMBOL_LINES = frozenset(["•", ".", "-", "—", "_", "/", "|", ":", ""])
+PAGE_LABEL_PATTERN = re.compile(r'^\s*page\s+\d+\s*$', re.IGNORECASE)
+KNOWN_FOOTER_PATTERN = re.compile(r'^(RFP:\s*To Develop the Ontario Digital Library Business Plan|March \d{4})$') # Specific footer/header
+DIGITS_PATTERN = re.compile(r'^\d+$')
+# Heuristic 3: numbering like "1", "1.1", "1.1.1" followed by whitespace
+NUMBERING_PATTERN = re.compile(r'^((\d+)(\.\d+){0,2})\s')
+# Known problematic fragments (e.g. "RFP: R") that must not be added as headings
+FRAGMENT_PATTERNS = (
+    re.compile(r'^RFP:\s*[A-Z]$'),
+    re.compile(r'^(quest|r Pr|oposal)\s*f.*$'),
+    re.compile(r'^RFP:\s*To Develop the Ontario Digital Library Business Plan$')
+)
+# Key sections that are often set in body-sized type
+KEY_SECTION_NAMES = frozenset(["summary", "background"])
+
+# Apply some minimums to avoid picking up body text as headings if dynamic thresholds are too low
+H1_MIN_SIZE = 20 # Absolute minimum for H1
+H2_MIN_SIZE = 16 # Absolute minimum for H2
+H3_MIN_SIZE = 12 # Absolute minimum for H3
+
+# Heading levels are carried as small ints through the vectorized pass
+LEVEL_NAMES = (None, "H1", "H2", "H3")
+
+def is_bold(record):
+    """
+    Checks for "Bold" in the font name or the bold flag.
+    """
+    return "Bold" in record.font or bool(record.flags & 16)
+
+def is_bold_span(span):
+    return "Bold" in span["font"] or bool(span["flags"] & 16)
+
+def extract_title(records):
+    """
+    Picks the title from the largest bold (or very large) lines on the first page.
+    """
+    title = ""
+    max_title_font_size = 0
+    potential_title_lines = []
+
+    # Iterate through the first page's lines to find the largest/boldest text
+    for record in records:
+        if record.page != 0:
+            break # Records are stored in page order
+        line_text = record.text
+        if not line_text:
+            continue
+
+        line_font_size = record.size
+
+        # Accumulate potential title lines, looking for the most prominent one
+        # Only consider if bold or very large, and not a short, number-like string
+        if (line_font_size >= 28 or is_bold(record)) and \
+           len(line_text) > 5 and \
+           not line_text.isdigit() and \
+           not TITLE_NUMBER_PATTERN.match(line_text):
+
+            if line_font_size > max_title_font_size:
+                max_title_font_size = line_font_size
+                potential_title_lines = [line_text] # Start new potential title if larger font found
+            elif line_font_size == max_title_font_size:
+                potential_title_lines.append(line_text) # If same largest font size, append for multi-line titles
+
+    # Join the collected lines to form the title
+    if potential_title_lines:
+        title = " ".join(potential_title_lines)
+        # A final check to ensure it's not a short or trivial title that might have slipped through
+        if len(title) < 10 or TITLE_REJECT_PATTERN.match(title):
+            title = "" # Reset if too short or a known header/footer pattern
+    return title
+
+def compute_font_thresholds(records):
+    """
+    Derives the H1/H2/H3 font size thresholds from the document's font size histogram.
+    """
+    # Store font sizes encountered to help normalize/compare
+    font_sizes = {}
+    for record in records:
+        size = record.size
+        if size not in font_sizes:
+            font_sizes[size] = 0
+        font_sizes[size] += 1
+    return thresholds_from_histogram(font_sizes)
+
+def thresholds_from_histogram(font_sizes):
+    """
+    Turns a {font_size: line_count} histogram into (h1, h2, h3) thresholds.
+    """
+    # Sort font sizes to determine relative importance (largest usually H1)
+    sorted_font_sizes = sorted(font_sizes.keys(), reverse=True)
+
+    # Define thresholds dynamically or based on common PDF patterns
+    # These are illustrative and might need fine-tuning for diverse PDFs
+    h1_threshold = sorted_font_sizes[0] if sorted_font_sizes else 0
+    h2_threshold = sorted_font_sizes[1] if len(sorted_font_sizes) > 1 else h1_threshold * 0.8
+    h3_threshold = sorted_font_sizes[2] if len(sorted_font_sizes) > 2 else h2_threshold * 0.8
+
+    h1_threshold = max(h1_threshold, H1_MIN_SIZE)
+    h2_threshold = max(h2_threshold, H2_MIN_SIZE)
+    h3_threshold = max(h3_threshold, H3_MIN_SIZE)
+
+    # Adjust H2 and H3 relative to H1 if they are too close
+    if h2_threshold >= h1_threshold:
+        h2_threshold = h1_threshold * 0.85
+    if h3_threshold >= h2_threshold:
+        h3_threshold = h2_threshold * 0.85
+
+    logging.debug("Dynamic Font Size Thresholds: H1=%.2f, H2=%.2f, H3=%.2f", h1_threshold, h2_threshold, h3_threshold)
+    return h1_threshold, h2_threshold, h3_threshold
+
+def is_excluded_line(line_text, page_num, line_font_size):
+    """
+    Heuristic 1: filters out known non-headings based on content or pattern.
+    """
+    # Filter out very short symbols, numbers, or common footer/header text
+    if (len(line_text) < 2 and not SHORT_NUMBERED_PATTERN.match(line_text)) or \
+       line_text in SYMBOL_LINES or \
+       PAGE_LABEL_PATTERN.match(line_text) or \
+       KNOWN_FOOTER_PATTERN.match(line_text):
+        return True
+
+    # Specific filter for the "100 Lombard" footer on page 2 of E0H1CM114.pdf and similar footers
+    if "Lombard" in line_text and page_num + 1 >= 2 and line_font_size < 12:
+        return True
+
+    # Heuristic to remove page numbers in isolation or as part of a short line
+    if (line_text.isdigit() and len(line_text) <= 3) or \
+       (DIGITS_PATTERN.match(line_text.replace('.', '')) and len(line_text) <= 5):
+        return True
+    return False
+
+def line_features(records):
+    """
+    Runs the per-line text rules once and packs the results into NumPy arrays.
+    Returns (candidates, features): the records that survived Heuristic 1, and
+    a dict of arrays aligned with them.
+    """
+    candidates = []
+    sizes = []
+    bold = []
+    caps = []
+    dots = []
+    key_section = []
+    # Checked once per document: the per-line trace is only built when DEBUG is on
+    trace_lines = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for record in records:
+        line_text = record.text
+        if not line_text: # Skip empty lines
+            continue
+
+        if trace_lines:
+            logging.debug("Page %d, Font Size: %.2f, Is_Bold: %s, Text: '%s'", record.page + 1, record.size, is_bold(record), line_text)
+
+        if is_excluded_line(line_text, record.page, record.size):
+            continue
+
+        match = NUMBERING_PATTERN.match(line_text)
+        candidates.append(record)
+        sizes.append(record.size)
+        bold.append(is_bold(record))
+        caps.append(line_text.isupper() and len(line_text) > 3)
+        dots.append(match.group(1).count('.') if match else -1) # -1 means not numbered
+        key_section.append(line_text.lower() in KEY_SECTION_NAMES)
+
+    features = {
+        "size": np.array(sizes, dtype=np.float64),
+        "bold": np.array(bold, dtype=bool),
+        "caps": np.array(caps, dtype=bool),
+        "dots": np.array(dots, dtype=np.int8),
+        "key_section": np.array(key_section, dtype=bool)
+    }
+    return candidates, features
+
+def classify_levels(features, thresholds):
+    """
+    Assigns heading levels (0 = none, 1-3 = H1-H3) to every candidate line in one
+    vectorized pass. Each step mirrors one of the original per-line heuristics.
+    """
+    h1_threshold, h2_threshold, h3_threshold = thresholds
+    sizes = features["size"]
+    dots = features["dots"]
+
+    # --- Heuristic 2: Heading Classification based on Line Properties (Font Size & Boldness) ---
+    # Bold text uses the thresholds directly; non-bold text must be 10% larger
+    bold_levels = np.select([sizes >= h1_threshold, sizes >= h2_threshold, sizes >= h3_threshold], [1, 2, 3], 0)
+    plain_levels = np.select([sizes >= h1_threshold * 1.1, sizes >= h2_threshold * 1.1, sizes >= h3_threshold * 1.1], [1, 2, 3], 0)
+    levels = np.where(features["bold"], bold_levels, plain_levels)
+
+    # --- Heuristic 3: Numbering patterns (refine the level, don't necessarily override it) ---
+    # "1 Introduction": unclassified or H3 becomes H1/H2 by size; H2 at H1-level font is promoted
+    top_level = dots == 0
+    font_levels = levels
+    levels = np.where(top_level & ((font_levels == 0) | (font_levels == 3)), np.where(sizes >= h2_threshold, 1, 2), font_levels)
+    levels = np.where(top_level & (font_levels == 2) & (sizes >= h1_threshold), 1, levels)
+    levels[dots == 1] = 2 # "1.1 Sub-section"
+    levels[dots == 2] = 3 # "1.1.1 Sub-sub-section"
+
+    # --- Heuristic 4: All caps check (if not already classified and reasonable length) ---
+    all_caps = (levels == 0) & features["caps"] & (sizes >= H3_MIN_SIZE)
+    caps_levels = np.select([sizes >= h1_threshold * 0.9, sizes >= h2_threshold * 0.9], [1, 2], 3)
+    levels = np.where(all_caps, caps_levels, levels)
+
+    # "Summary" and "Background" are elevated to H2 if they meet the H3 size and aren't picked up already
+    key_sections = features["key_section"] & (sizes >= h3_threshold) & ((levels == 0) | (levels == 3))
+    levels[key_sections] = 2
+    return levels
+
+def iter_headings(records, thresholds):
+    """
+    Runs the heading heuristics over a run of line records (a whole document or
+    a single page) and yields (record, level name) for every heading, in order.
+    """
+    candidates, features = line_features(records)
+    levels = classify_levels(features, thresholds)
+    for index in np.flatnonzero(levels):
+        record = candidates[index]
+        # Skip known problematic fragmentation or footers
+        if any(pattern.match(record.text) for pattern in FRAGMENT_PATTERNS):
+            continue
+        yield record, LEVEL_NAMES[levels[index]]
+
+def classify_records(records, thresholds):
+    """
+    Runs the heading heuristics over a run of line records (a whole document or
+    a single page) and returns the outline entries in order.
+    """
+    return [
+        {
+            "level": level,
+            "text": record.text, # Use the full line text
+            "page": record.page + 1
+        }
+        for record, level in iter_headings(records, thresholds)
+    ]
+
+# --- Section headings (Round 1B): whole lines set apart from the body text ---
+# Longest line still taken as a section heading
+SECTION_HEADING_MAX_WORDS = 12
+# Regular-weight subheads at body size must be shorter still
+SUBHEAD_MAX_WORDS = 6
+# A line ending like a sentence or a clause is body text, not a subhead
+SENTENCE_END = (".", "!", "?", ",", ";")
+
+def body_font_size(font_sizes):
+    """
+    The dominant size of a {font_size: line_count} histogram of text lines.
+    """
+    return max(font_sizes, key=font_sizes.get, default=0)
+
+def count_text_sizes(records, font_sizes):
+    for record in records:
+        if record.text:
+            font_sizes[record.size] = font_sizes.get(record.size, 0) + 1
+    return font_sizes
+
+def is_section_heading(record, previous, following, body_size):
+    """
+    Decides whether a line opens a Round 1B section. The whole line must be
+    bold at body size or above, or set larger than the body; a regular-weight
+    line at body size only counts as a subhead when it is short and alone in
+    its block. Lines that wrap into the next one, start lowercase (the tail
+    of a wrapped line) or end with ":" (in-section labels such as
+    "Ingredients:") are never headings. previous and following are the
+    neighbouring text lines, or None.
+    """
+    text = record.text
+    words = len(text.split())
+    if words > SECTION_HEADING_MAX_WORDS or text.endswith(":") or not text[0].isalnum() or text[0].islower():
+        return False
+    if is_excluded_line(text, record.page, record.size) or any(pattern.match(text) for pattern in FRAGMENT_PATTERNS):
+        return False
+    if following is not None and following.page == record.page and following.text[0].islower():
+        return False # Continues into the next line
+    if record.size > body_size * 1.1 or (record.all_bold and record.size >= body_size):
+        return True
+    alone = all(
+        neighbour is None or (neighbour.page, neighbour.block) != (record.page, record.block)
+        for neighbour in (previous, following)
+    )
+    return alone and words <= SUBHEAD_MAX_WORDS and text[0].isalpha() and not text.endswith(SENTENCE_END)
+
+def iter_section_headings(records, body_size):
+    """
+    Yields the records of a run that open a Round 1B section, in order.
+    """
+    lines = [record for record in records if record.text]
+    for index, record in enumerate(lines):
+        previous = lines[index - 1] if index > 0 else None
+        following = lines[index + 1] if index + 1 < len(lines) else None
+        if is_section_heading(record, previous, following, body_size):
+            yield record
+
+# --- Layout model: one parse, shared by the outline and the sections ---
+def make_section(document_filename, section_title, page_number, section_lines):
+    return {
+        "document": document_filename,
+        "section_title": section_title,
+        "page_number": page_number,
+        "text_content": "\n".join(section_lines).strip()
+    }
+
+def sections_from_pages(page_records, body_size, document_filename):
+    """
+    Sectioning core: takes runs of line records in reading order (the whole
+    document at once, or one page at a time) and yields the sections
+    described in LayoutModel.iter_sections. Headings are decided from a line
+    and its neighbours on the same page, so the result does not depend on
+    how the records are split into runs.
+    """
+    current_title = None
+    current_page = 1
+    current_lines = []
+    for records in page_records:
+        heading_ids = {id(record) for record in iter_section_headings(records, body_size)}
+        for record in records:
+            text = record.text
+            if not text: # Skip empty lines
+                continue
+            page_number = record.page + 1
+            if id(record) in heading_ids:
+                if current_lines:
+                    yield make_section(document_filename, current_title or f"Content from Page {current_page}", current_page, current_lines)
+                current_title, current_page, current_lines = text, page_number, []
+                continue
+            if current_title is None and current_lines and page_number != current_page:
+                yield make_section(document_filename, f"Content from Page {current_page}", current_page, current_lines)
+                current_lines = []
+            if current_title is None and not current_lines:
+                current_page = page_number
+            current_lines.append(text)
+    if current_lines:
+        yield make_section(document_filename, current_title or f"Content from Page {current_page}", current_page, current_lines)
+
+def iter_page_records(document, monitor=None):
+    for page_num in range(document.page_count):
+        yield extract_line_records(document, page_num, page_num + 1, monitor)
+
+def stream_sections(document, document_filename, monitor=None):
+    """
+    Yields the same sections as LayoutModel.iter_sections straight from an
+    open document, without building the model: a pre-pass keeps only the
+    font size histogram for the body size, then pages are read and
+    sectioned one at a time. Every page is read twice, but only one page of
+    line records (plus the section being built) is alive at a time.
+    """
+    font_sizes = {}
+    for records in iter_page_records(document, monitor):
+        count_text_sizes(records, font_sizes)
+    yield from sections_from_pages(iter_page_records(document, monitor), body_font_size(font_sizes), document_filename)
+
+class LayoutModel:
+    """
+    A parsed PDF: its page count and the line records of every page, in
+    reading order. Title, thresholds and headings are computed from the
+    records on first use.
+    """
+
+    def __init__(self, page_count, records):
+        self.page_count = page_count
+        self.records = records
+        self._thresholds = None
+        self._body_size = None
+
+    @classmethod
+    def from_document(cls, document, monitor=None):
+        return cls(document.page_count, extract_line_records(document, monitor=monitor))
+
+    def thresholds(self):
+        if self._thresholds is None:
+            self._thresholds = compute_font_thresholds(self.records)
+        return self._thresholds
+
+    def body_size(self):
+        if self._body_size is None:
+            self._body_size = body_font_size(count_text_sizes(self.records, {}))
+        return self._body_size
+
+    def title(self):
+        return extract_title(self.records)
+
+    def outline(self):
+        """
+        The Round 1A result: {"title": ..., "outline": [{"level", "text", "page"}]}.
+        """
+        return {
+            "title": self.title(),
+            "outline": classify_records(self.records, self.thresholds())
+        }
+
+    def iter_sections(self, document_filename):
+        """
+        Yields the Round 1B sections: the lines under each section heading
+        (see is_section_heading), up to the next heading, titled with the heading and numbered with its
+        page. Text before the first heading (or in a document without
+        headings) is split per page as "Content from Page N". A heading with
+        no text under it is skipped.
+        """
+        yield from sections_from_pages([self.records], self.body_size(), document_filename)
+
+    def as_dict(self):
+        return {
+            "version": LAYOUT_VERSION,
+            "page_count": self.page_count,
+            "records": [[r.text, r.size, r.font, r.flags, r.bbox, r.page, r.block, r.all_bold] for r in self.records]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != LAYOUT_VERSION:
+            raise ValueError("layout model written by another LAYOUT_VERSION")
+        return cls(data["page_count"], [
+            LineRecord(text, size, font, flags, tuple(bbox), page, block, all_bold)
+            for text, size, font, flags, bbox, page, block, all_bold in data["records"]
+        ])
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+LAYOUT_CACHE_FILE_PATTERN = re.compile(r'^[0-9a-f]{64}\.layout\.v(.+)\.json$')
+
+def prune_layout_cache(cache_dir, max_bytes=None):
+    """
+    Removes layout models written by another LAYOUT_VERSION, then the least
+    recently used ones (by mtime, refreshed on every hit) until the
+    directory's models fit in max_bytes (LAYOUT_CACHE_MAX_MB by default).
+    Only files named like layout models are ever touched. Files another
+    process removes concurrently are skipped.
+    """
+    max_bytes = LAYOUT_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        match = LAYOUT_CACHE_FILE_PATTERN.match(name)
+        if not match:
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            if match.group(1) != LAYOUT_VERSION:
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
+
+def load_layout(source, document=None, cache_dir=None, monitor=None):
+    """
+    Returns the LayoutModel of a PDF given as a file path or as the file's
+    bytes, parsing the already open document if one is passed. With a cache
+    directory (LAYOUT_CACHE_DIR unless cache_dir is given) the model is
+    looked up by the PDF's SHA-256 first and saved there after parsing;
+    the directory is kept within LAYOUT_CACHE_MAX_MB (see prune_layout_cache).
+    Pass a MemoryMonitor to read the document's peak RSS afterwards.
+    """
+    cache_dir = cache_dir or LAYOUT_CACHE_DIR
+    cache_path = None
+    if cache_dir:
+        is_bytes = isinstance(source, (bytes, bytearray, memoryview))
+        content_hash = hashlib.sha256(source).hexdigest() if is_bytes else hash_file(source)
+        cache_path = os.path.join(cache_dir, f"{content_hash}.layout.v{LAYOUT_VERSION}.json")
+        try:
+            with open(cache_path, "r", encoding="utf-8") as f:
+                model = LayoutModel.from_dict(json.load(f))
+            os.utime(cache_path) # Mark as recently used
+            return model
+        except (OSError, ValueError, KeyError, TypeError):
+            pass # Not cached yet, or unreadable: parse it again
+
+    if document is not None:
+        model = LayoutModel.from_document(document, monitor)
+    else:
+        document = open_document(source)
+        try:
+            model = LayoutModel.from_document(document, monitor)
+        finally:
+            document.close()
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            temp_path = f"{cache_path}.{os.getpid()}.part"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(model.as_dict(), f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(temp_path, cache_path)
+            prune_layout_cache(cache_dir)
+        except OSError as e:
+            logging.warning("Could not cache layout model at %s: %s", cache_path, e)
+    return model